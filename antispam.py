@@ -4,14 +4,27 @@ This file is adapted from Red-DiscordBot, which is licensed under GPLv3.
 https://github.com/Cog-Creators/Red-DiscordBot/blob/V3/develop/redbot/core/utils/antispam.py
 """
 
-from datetime import datetime, timedelta
+from array import array
 from collections import namedtuple
+from datetime import timedelta
+from functools import lru_cache
+from math import inf
+from time import monotonic
 
 __all__ = ("AntiSpam",)
 
 _AntiSpamInterval = namedtuple("_AntiSpamInterval", ["period", "frequency"])
 
 
+@lru_cache
+def _compile_intervals(
+    intervals: tuple[tuple[timedelta, int], ...]
+) -> tuple[tuple[_AntiSpamInterval, ...], tuple[tuple[float, int], ...]]:
+    compiled = tuple(_AntiSpamInterval(*x) for x in intervals)
+    # plain (seconds, frequency) pairs, to avoid doing any timedelta math on every check
+    return compiled, tuple((x.period.total_seconds(), x.frequency) for x in compiled)
+
+
 class AntiSpam:
     """
     A class that can be used to count the number of events that happened
@@ -96,29 +109,39 @@ class AntiSpam:
         (timedelta(days=1), 24),
     ]
 
+    __slots__ = ("__intervals", "__checks", "__event_timestamps", "__head")
+
     def __init__(self, intervals: list[tuple[timedelta, int]]):
-        self.__event_timestamps = []
         _itvs = intervals or self.default_intervals
-        self.__intervals = [_AntiSpamInterval(*x) for x in _itvs]
-        self.__discard_after = max([x.period for x in self.__intervals])
-
-    def __interval_check(self, interval: _AntiSpamInterval):
-        return (
-            len([t for t in self.__event_timestamps if (t + interval.period) > datetime.utcnow()])
-            >= interval.frequency
-        )
-
-    def _valid_timestamps(self, interval: _AntiSpamInterval):
-        return [t for t in self.__event_timestamps if (t + interval.period) > datetime.utcnow()]
+        # these are shared between every instance using the same intervals, as there's
+        # typically one of these per user
+        self.__intervals, self.__checks = _compile_intervals(tuple(map(tuple, _itvs)))
+        # whether an interval has been exceeded only depends on its frequency-th most recent
+        # event, so only as many monotonic timestamps as the largest frequency are kept around,
+        # in a ring that's overwritten oldest first.
+        size = max(1, *(x[1] for x in self.__checks))
+        self.__event_timestamps = array("d", [-inf]) * size
+        self.__head = 0
+
+    def __nth_latest(self, n: int) -> float:
+        timestamps = self.__event_timestamps
+        return timestamps[(self.__head - n) % len(timestamps)]
+
+    def __interval_check(self, period: float, frequency: int, now: float) -> bool:
+        return frequency <= 0 or self.__nth_latest(frequency) + period > now
 
     def interval_cooldowns(self) -> dict[_AntiSpamInterval, timedelta | None]:
         """Get the time remaining for an interval to no longer consider an action spammy"""
-        now = datetime.utcnow()
+        now = monotonic()
         intervals = {}
-        for interval in self.__intervals:
-            timestamps = self._valid_timestamps(interval)
-            if len(timestamps) >= interval.frequency:
-                intervals[interval] = interval.period - (now - min(timestamps))
+        for interval, (period, frequency) in zip(self.__intervals, self.__checks):
+            if self.__interval_check(period, frequency, now):
+                oldest = next(
+                    t
+                    for t in map(self.__nth_latest, range(len(self.__event_timestamps), 0, -1))
+                    if t + period > now
+                )
+                intervals[interval] = timedelta(seconds=period - (now - oldest))
             else:
                 intervals[interval] = None
         return intervals
@@ -138,7 +161,11 @@ class AntiSpam:
         Whether, for any interval, the number of events that happened
         within that interval exceeds the number specified for that interval.
         """
-        return any(self.__interval_check(x) for x in self.__intervals)
+        now = monotonic()
+        for period, frequency in self.__checks:
+            if self.__interval_check(period, frequency, now):
+                return True
+        return False
 
     def stamp(self):
         """
@@ -148,7 +175,5 @@ class AntiSpam:
         The stamp will last until the corresponding interval duration
         has expired (set when this AntiSpam object was initiated).
         """
-        self.__event_timestamps.append(datetime.utcnow())
-        self.__event_timestamps = [
-            t for t in self.__event_timestamps if t + self.__discard_after > datetime.utcnow()
-        ]
+        self.__event_timestamps[self.__head] = monotonic()
+        self.__head = (self.__head + 1) % len(self.__event_timestamps)
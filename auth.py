@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import os
+
+from pymongo.errors import PyMongoError
+
+from cache import TTLCache
+from db import User
+
+__all__ = ("KeyCache", "key_cache")
+log = logging.getLogger("auth")
+
+
+class KeyCache:
+    """In-memory cache of API key to user lookups
+
+    Every mod reconnects within a few seconds of the server restarting, so this avoids having
+    every single one of those handshakes go to the database. Entries are invalidated by
+    Discord user ID whenever a user is banned, muted, or has their key changed.
+    """
+
+    def __init__(self):
+        self._cache: TTLCache[str, User] = TTLCache(maxsize=10_000, ttl=300)
+        # Discord user ID -> key, for invalidating by user
+        self._keys: dict[int, str] = {}
+        self.serve_stale = False
+        self.timeout = 2.0
+
+    def load_config(self) -> None:
+        self._cache = TTLCache(
+            maxsize=int(os.getenv("KEY_CACHE_SIZE", 10_000)),
+            ttl=float(os.getenv("KEY_CACHE_TTL", 300)),
+        )
+        self._keys.clear()
+        self.serve_stale = bool(os.getenv("KEY_CACHE_SERVE_STALE"))
+        self.timeout = float(os.getenv("KEY_CACHE_TIMEOUT", 2))
+
+    async def get(self, key: str) -> User | None:
+        if user := self._cache.get(key):
+            return user
+
+        stale = self._cache.get_stale(key) if self.serve_stale else None
+        try:
+            if stale is not None:
+                # there's something to fall back on, so don't bother waiting around for too long
+                user = await asyncio.wait_for(User.find_one({"key": key}), self.timeout)
+            else:
+                user = await User.find_one({"key": key})
+        except (asyncio.TimeoutError, PyMongoError) as e:
+            # banned users are still rejected as usual by the caller
+            if stale is None:
+                raise
+            log.warning("Failed to lookup key, serving stale user %s", stale.user_id, exc_info=e)
+            return stale
+
+        if user is None:
+            self._cache.pop(key)
+            return None
+        if (previous := self._keys.get(user.user_id)) is not None and previous != key:
+            self._cache.pop(previous)
+        self._cache.set(key, user)
+        self._keys[user.user_id] = key
+        if len(self._keys) > self._cache.maxsize * 2:
+            # drop anything that's since been evicted from the cache itself
+            self._keys = {v.user_id: k for k, v in self._cache.items()}
+        return user
+
+    def invalidate(self, user_id: int) -> None:
+        """Drop any cached lookups for the given Discord user"""
+        if (key := self._keys.pop(user_id, None)) is not None:
+            self._cache.pop(key)
+
+
+key_cache = KeyCache()
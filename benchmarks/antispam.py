@@ -0,0 +1,103 @@
+"""
+Compares the cost of AntiSpam checks against the previous list-based implementation.
+
+Run with ``python -m benchmarks.antispam`` from the repository root.
+"""
+
+import argparse
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta
+
+from antispam import AntiSpam
+
+# the same intervals used by both the server and the bot
+INTERVALS = [
+    (timedelta(seconds=4), 5),
+    (timedelta(seconds=10), 10),
+    (timedelta(seconds=60), 40),
+]
+
+
+class LegacyAntiSpam:
+    """The previous AntiSpam implementation, kept around as a point of comparison"""
+
+    def __init__(self, intervals: list[tuple[timedelta, int]]):
+        self.event_timestamps = []
+        self.intervals = intervals
+        self.discard_after = max([x[0] for x in self.intervals])
+
+    def interval_check(self, interval):
+        return (
+            len([t for t in self.event_timestamps if (t + interval[0]) > datetime.utcnow()])
+            >= interval[1]
+        )
+
+    @property
+    def spammy(self):
+        return any(self.interval_check(x) for x in self.intervals)
+
+    def stamp(self):
+        self.event_timestamps.append(datetime.utcnow())
+        self.event_timestamps = [
+            t for t in self.event_timestamps if t + self.discard_after > datetime.utcnow()
+        ]
+
+
+def _filled(cls, stamps: int):
+    # stamps are forced in regardless of whether they'd be considered spammy, so that every
+    # check has to consider a full window
+    limiter = cls(INTERVALS)
+    for _ in range(stamps):
+        limiter.stamp()
+    return limiter
+
+
+def _footprint(cls, count: int, stamps: int) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    limiters = [_filled(cls, stamps) for _ in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del limiters
+    return (after - before) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=20_000)
+    parser.add_argument("--limiters", type=int, default=5_000)
+    args = parser.parse_args()
+
+    print(f"{'stamps':>6} | {'operation':>9} | {'legacy':>10} | {'current':>10} | speedup")
+    for stamps in (0, 9, 39):
+        for name, stmt, number, repeat in (
+            ("spammy", "x.spammy", args.number, 5),
+            # stamping grows the window, so each stamp starts from a freshly filled limiter
+            ("stamp", "x.stamp()", 1, 500),
+        ):
+            legacy, current = (
+                min(
+                    timeit.repeat(
+                        stmt,
+                        setup=f"x = _filled(cls, {stamps})",
+                        globals={"_filled": _filled, "cls": cls},
+                        number=number,
+                        repeat=repeat,
+                    )
+                )
+                / number
+                for cls in (LegacyAntiSpam, AntiSpam)
+            )
+            print(
+                f"{stamps:>6} | {name:>9} | {legacy * 1e6:>7.2f} µs | {current * 1e6:>7.2f} µs"
+                f" | {legacy / current:.1f}x"
+            )
+
+    for cls in (LegacyAntiSpam, AntiSpam):
+        size = _footprint(cls, args.limiters, 40)
+        print(f"{cls.__name__} with 40 stamps: ~{size:.0f} bytes per limiter")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Measures the CPU cost of fanning a single chat message out to every connection.
+
+Drives the real delivery path: ``ConnectionManager.deliver`` records each message in the
+history and hands it to every connection's send queue, whose dispatchers then write it out to
+stub websockets. Everything that happens per message is measured (including history, metrics
+and MessagePack encoding), except the socket I/O itself.
+
+Run with ``python -m benchmarks.broadcast`` from the repository root.
+"""
+
+import argparse
+import asyncio
+import time
+from uuid import uuid4
+
+from connections import ConnectionManager, UserConnection
+from frames import encode
+
+# api version, encoding
+MODES = {
+    "v1": (1, "json"),
+    "v2-json": (2, "json"),
+    "v2-msgpack": (2, "msgpack"),
+}
+
+
+class Delivered:
+    """Keeps track of how many connections have yet to have a message written to them"""
+
+    def __init__(self):
+        self.remaining = 0
+        self.event = asyncio.Event()
+
+    def expect(self, count: int) -> None:
+        self.remaining = count
+        self.event.clear()
+
+    def written(self) -> None:
+        self.remaining -= 1
+        if not self.remaining:
+            self.event.set()
+
+
+class StubWebSocket:
+    """Stand-in for a Starlette websocket that only does the encoding work the real one would"""
+
+    def __init__(self, delivered: Delivered):
+        self.delivered = delivered
+
+    async def send_text(self, data: str):
+        # this mirrors what starlette does before writing a text frame
+        data.encode("utf-8")
+        self.delivered.written()
+
+    async def send_bytes(self, data: bytes):
+        self.delivered.written()
+
+    async def close(self, code: int = 1000, reason: str | None = None):
+        pass
+
+
+async def run(connections: int, messages: int, *, mode: str) -> float:
+    api_version, encoding = MODES[mode]
+    delivered = Delivered()
+    manager = ConnectionManager()
+    users = [
+        UserConnection(
+            f"player{i}", StubWebSocket(delivered), api_version=api_version, encoding=encoding
+        )
+        for i in range(connections)
+    ]
+    # connecting for real needs a user document from the database; delivery only ever looks at
+    # active_connections anyways
+    manager.active_connections.update(users)
+
+    start = time.process_time()
+    for _ in range(messages):
+        payload = {
+            "author": "[DISCORD] Someone, replying to Someone Else",
+            "message": "this is a fairly typical chat message, maybe with a bit of unicode ✔",
+            "nonce": str(uuid4()),
+        }
+        # one message at a time, so that API v2 connections never batch anything together
+        delivered.expect(connections)
+        manager.deliver(encode(payload))
+        await delivered.event.wait()
+    elapsed = time.process_time() - start
+
+    for user in users:
+        user.queue_dispatcher.cancel()
+    return elapsed / messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200, help="messages to broadcast per run")
+    parser.add_argument("--connections", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    args = parser.parse_args()
+
+    print(f"{'connections':>11} | " + " | ".join(f"{x:>16}" for x in args.modes))
+    for n in args.connections:
+        results = [asyncio.run(run(n, args.messages, mode=x)) for x in args.modes]
+        print(f"{n:>11} | " + " | ".join(f"{x * 1e6:>13.1f} µs" for x in results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Compares mention rewriting against the previous one-str.replace-per-mention implementation.
+
+Messages are long chains of pings, which is where the previous implementation was worst off;
+the linked account lookup is left out, as both implementations share it.
+
+Run with ``python -m benchmarks.mentions`` from the repository root.
+"""
+
+import argparse
+import re
+import timeit
+from types import SimpleNamespace
+
+from mentions import Mentions
+
+USER_MENTION = re.compile(r"<@!?(\d+)>")
+CHANNEL_MENTION = re.compile(r"<#?(\d+)>")
+
+
+def limit_character_set(string):
+    # a copy of the sanitizer from the bridge cog, which can't be imported without discord.py
+    return "".join(c for c in string if 0 < ord(c) < 127)
+
+
+class FakeGuild:
+    def __init__(self, members: int):
+        self.members = {
+            1000 + i: SimpleNamespace(display_name=f"Member ✨ {i}") for i in range(members)
+        }
+        self.channels = {1: "general"}
+
+    def get_member(self, member_id: int):
+        return self.members.get(member_id)
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+
+def legacy_sub_mentions(guild: FakeGuild, message: str, linked_users: dict[int, str]) -> str:
+    """The previous implementation of Bridge.sub_mentions, minus the database lookup"""
+    mentions = [*USER_MENTION.finditer(message)]
+    for mention, uid in {str(x.group(0)): int(x.group(1)) for x in mentions}.items():
+        if uid in linked_users:
+            message = message.replace(mention, f"@{linked_users[uid]}")
+        else:
+            user = guild.get_member(uid)
+            if user:
+                message = message.replace(
+                    mention, f"@{limit_character_set(user.display_name) or str(user)}"
+                )
+            else:
+                message = message.replace(mention, "@unknown-user")
+
+    for mention in CHANNEL_MENTION.finditer(message):
+        channel = guild.get_channel(int(mention.group(1)))
+        if channel:
+            message = message.replace(mention.group(0), f"#{limit_character_set(str(channel))}")
+        else:
+            message = message.replace(mention.group(0), "#unknown-channel")
+    return message
+
+
+def ping_chain(mentions: int, unique: int) -> str:
+    # every tenth ping is followed by a channel mention, to exercise both kinds of mentions
+    return " ".join(
+        f"<@{1000 + i % unique}>" + (" <#1>" if i % 10 == 0 else "") for i in range(mentions)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    guild = FakeGuild(members=500)
+    linked = {1000 + i: f"player{i}" for i in range(0, 500, 3)}
+    mentions = Mentions(limit_character_set, guild.get_member, guild.get_channel)
+
+    print(f"{'mentions':>8} | {'unique':>6} | {'legacy':>10} | {'current':>10} | speedup")
+    for count, unique in ((10, 10), (50, 50), (200, 20), (200, 200), (500, 500)):
+        message = ping_chain(count, unique)
+        assert legacy_sub_mentions(guild, message, linked) == mentions.rewrite(message, linked)
+        legacy = min(
+            timeit.repeat(
+                lambda: legacy_sub_mentions(guild, message, linked), number=args.number, repeat=5
+            )
+        )
+        current = min(
+            timeit.repeat(lambda: mentions.rewrite(message, linked), number=args.number, repeat=5)
+        )
+        print(
+            f"{count:>8} | {unique:>6} | {legacy / args.number * 1e6:>7.1f} µs"
+            f" | {current / args.number * 1e6:>7.1f} µs | {legacy / current:.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
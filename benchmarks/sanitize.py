@@ -0,0 +1,63 @@
+"""
+Compares the cost of sanitizing messages sent from Discord against the previous implementation.
+
+Run with ``python -m benchmarks.sanitize`` from the repository root.
+"""
+
+import argparse
+import random
+import timeit
+
+from sanitize import SMART_QUOTES, Sanitizer
+
+CORPUS = {
+    "short ascii": "gg",
+    "typical": "anyone wanna do some dungeons? I'm about to start an f7 run",
+    "smart quotes": "“that’s not how it works” – someone, probably\nsecond line",
+    "allowed symbols": "✔ done ❤ thanks ☠ rip " * 4,
+    # 2000 characters is as long as a discord message can get
+    "long ascii": ("the quick brown fox jumps over the lazy dog " * 50)[:2000],
+    "long disallowed": "日本語のテキスト" * 250,
+    "many codepoints": "".join(chr(x) for x in random.Random(0).sample(range(0x100, 0x3000), 2000)),
+    "newline spam": "a\n" * 1000,
+}
+
+
+class LegacySanitizer:
+    """The previous sanitization steps from Bridge.on_message, minus emoji and mentions"""
+
+    def __init__(self, allowed: frozenset[str]):
+        self.allowed = set(allowed)
+
+    def limit_character_set(self, string):
+        return "".join(c for c in string if 0 < ord(c) < 127 or c in self.allowed)
+
+    def __call__(self, content: str) -> str:
+        content = content.replace("\n", " ")
+        content = content.translate(SMART_QUOTES)
+        return self.limit_character_set(content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=2_000)
+    args = parser.parse_args()
+
+    sanitizer = Sanitizer()
+    sanitizer.load()
+    legacy = LegacySanitizer(sanitizer.allowed)
+
+    print(f"{'input':>16} | {'length':>6} | {'legacy':>10} | {'current':>10} | speedup")
+    for name, text in CORPUS.items():
+        old, new = (
+            min(timeit.repeat(lambda: fn(text), number=args.number, repeat=5)) / args.number
+            for fn in (legacy, sanitizer.to_game)
+        )
+        print(
+            f"{name:>16} | {len(text):>6} | {old * 1e6:>7.2f} µs | {new * 1e6:>7.2f} µs"
+            f" | {old / new:.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+Times every helper run on each chat message, so that changes to them can be compared over time.
+
+Each benchmark runs a helper over every line of a corpus (or every input it takes), and reports
+the best time per line out of several repeats. Results are saved as JSON to
+``benchmarks/results/`` (or ``--output``); passing an earlier results file as ``--baseline``
+prints how each benchmark compares against it, and with ``--check`` exits with a non-zero status
+if any benchmark got slower than ``--threshold`` times its baseline.
+
+Benchmarks for helpers whose dependencies aren't installed are skipped.
+
+Run with ``python -m benchmarks.suite`` from the repository root.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import timeit
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable
+
+RESULTS_DIR = Path(__file__).parent / "results"
+_rng = random.Random(0)
+
+CORPORA: dict[str, list[str]] = {
+    "chat": [
+        "gg",
+        "anyone wanna do some dungeons? I'm about to start an f7 run",
+        "lf 2 m5 need healer and tank",
+        "what's the price of a hyperion rn",
+        "-bestiary",
+        "-5 coins per item is a rip off",
+        "- this isn't a command",
+        "lmao",
+        "does anyone know if the diana event is this week or next",
+        "§athis one came from the game §r§lwith formatting",
+        "brb",
+        "ty for the carry!!",
+    ]
+    * 4,
+    "pings": [
+        f"<@{1000 + _rng.randrange(500)}> " * n + f"look at this <#1> <:kekw:{10**17}>"
+        for n in (1, 2, 3, 5, 8, 13, 20)
+    ]
+    + [f"hey <@!{1000 + x}> <a:wave:{10**17 + x}> you coming?" for x in range(20)],
+    "unicode": [
+        "“that’s not how it works” – someone, probably",
+        "✔ done ❤ thanks ☠ rip",
+        "日本語のテキストも送れるかな",
+        "emoji spam 😀😃😄😁😆😅😂🤣",
+        "bidi ‮txet desrever‬ trickery",
+        "".join(chr(x) for x in _rng.sample(range(0x100, 0x3000), 200)),
+    ]
+    * 4,
+}
+DELTAS = [
+    timedelta(seconds=x)
+    for x in (0, 1, 59, 61, 3600, 3661, 86399, 86400 * 7 + 5, 86400 * 365, 123456.789)
+]
+DURATIONS = ["30s", "5m", "1h", "2h30m", "1d", "1 week", "1.5h", "3 days 4 hours", "1mo", "1y"]
+
+# name -> function which sets up the benchmark, returning the function to time and how many
+# items each call of it handles; setups may raise ImportError to skip a benchmark
+Setup = Callable[[], tuple[Callable[[], object], int]]
+BENCHMARKS: dict[str, Setup] = {}
+
+
+def benchmark(name: str, corpora: tuple[str, ...] = ()):
+    """Register a benchmark, once for every given corpus (if any)"""
+
+    def decorator(fn):
+        if not corpora:
+            BENCHMARKS[name] = fn
+        for corpus in corpora:
+            BENCHMARKS[f"{name}[{corpus}]"] = lambda corpus=corpus: fn(CORPORA[corpus])
+        return fn
+
+    return decorator
+
+
+def _over(fn: Callable[[str], object], lines: list) -> tuple[Callable[[], object], int]:
+    def run():
+        for line in lines:
+            fn(line)
+
+    return run, len(lines)
+
+
+@benchmark("antispam.spammy")
+def _spammy():
+    from antispam import AntiSpam
+    from benchmarks.antispam import INTERVALS
+
+    # a range of how full their windows are, as checks get more expensive the fuller they are
+    limiters = [AntiSpam(INTERVALS) for _ in range(10)]
+    for stamps, limiter in enumerate(limiters):
+        for _ in range(stamps):
+            limiter.stamp()
+    return _over(lambda x: x.spammy, limiters)
+
+
+@benchmark("antispam.stamp")
+def _stamp():
+    from antispam import AntiSpam
+    from benchmarks.antispam import INTERVALS
+
+    # stamps pile up for the duration of the longest interval, so that'd otherwise just keep
+    # getting slower the more times this is run
+    def run():
+        limiter = AntiSpam(INTERVALS)
+        for _ in range(10):
+            limiter.stamp()
+
+    return run, 10
+
+
+@benchmark("ratelimit.hit")
+def _ratelimit_hit():
+    from ratelimit import RateLimiter
+
+    # checked the same way as messages sent to the server, with each user sending a burst of
+    # messages; with the default policies, the last few of these are rejected, so both paths
+    # are measured. a fresh limiter is used for the same reason as in antispam.stamp
+    users = range(100)
+    burst = 8
+
+    def run():
+        limiter = RateLimiter()
+        for _ in range(burst):
+            for user in users:
+                limiter.hit(("global", None), ("user", user), ("connection", user))
+
+    return run, len(users) * burst
+
+
+@benchmark("sanitize.to_game", ("chat", "pings", "unicode"))
+def _to_game(lines: list[str]):
+    from sanitize import Sanitizer
+
+    sanitizer = Sanitizer()
+    sanitizer.load()
+    return _over(sanitizer.to_game, lines)
+
+
+@benchmark("sanitize.from_game", ("chat", "unicode"))
+def _from_game(lines: list[str]):
+    from sanitize import Sanitizer
+
+    return _over(Sanitizer().from_game, lines)
+
+
+@benchmark("mentions.rewrite", ("chat", "pings"))
+def _mentions(lines: list[str]):
+    from benchmarks.mentions import FakeGuild
+    from mentions import Mentions
+    from sanitize import Sanitizer
+
+    sanitizer = Sanitizer()
+    sanitizer.load()
+    guild = FakeGuild(members=500)
+    mentions = Mentions(sanitizer.to_game, guild.get_member, guild.get_channel)
+    linked = {1000 + i: f"player{i}" for i in range(0, 500, 3)}
+    return _over(lambda x: mentions.rewrite(x, linked), lines)
+
+
+@benchmark("is_possibly_soopy", ("chat",))
+def _soopy(lines: list[str]):
+    from sanitize import is_possibly_soopy
+
+    return _over(is_possibly_soopy, lines)
+
+
+@benchmark("FORMAT_CODE.sub", ("chat", "unicode"))
+def _format_code(lines: list[str]):
+    from sanitize import FORMAT_CODE
+
+    return _over(lambda x: FORMAT_CODE.sub("", x), lines)
+
+
+@benchmark("EMOJI.sub", ("chat", "pings"))
+def _emoji(lines: list[str]):
+    from sanitize import EMOJI
+
+    return _over(lambda x: EMOJI.sub(r"\1", x), lines)
+
+
+@benchmark("delta_to_str")
+def _delta_to_str():
+    from common import delta_to_str
+
+    return _over(delta_to_str, DELTAS)
+
+
+@benchmark("TimeRepresentation.str_to_delta")
+def _str_to_delta():
+    from time_converter.parser import TimeRepresentation
+
+    return _over(TimeRepresentation.str_to_delta, DURATIONS)
+
+
+def run(names: list[str], *, min_time: float, repeat: int) -> dict[str, float]:
+    """Run the given benchmarks, returning the best time per item in seconds for each"""
+    results = {}
+    for name in names:
+        try:
+            fn, items = BENCHMARKS[name]()
+        except ImportError as e:
+            print(f"{name:<40} skipped ({e})")
+            continue
+        timer = timeit.Timer(fn)
+        number, _ = timer.autorange()
+        # autorange only goes for 0.2s, which is a bit too noisy for comparing runs
+        number = max(1, int(number * min_time / 0.2))
+        results[name] = min(timer.repeat(repeat=repeat, number=number)) / number / items
+        print(f"{name:<40} {results[name] * 1e6:>10.3f} µs")
+    return results
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict[str, float], baseline: dict[str, float], threshold: float) -> list[str]:
+    """Print how each benchmark compares against a baseline, returning any that regressed"""
+    regressed = []
+    print()
+    print(f"{'benchmark':<40} | {'baseline':>10} | {'current':>10} | change")
+    for name, current in results.items():
+        if (previous := baseline.get(name)) is None:
+            continue
+        ratio = current / previous
+        if ratio > threshold:
+            regressed.append(name)
+        print(
+            f"{name:<40} | {previous * 1e6:>7.3f} µs | {current * 1e6:>7.3f} µs | {ratio:.2f}x"
+            + (" REGRESSED" if ratio > threshold else "")
+        )
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("filter", nargs="*", help="only run benchmarks containing any of these")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per repeat")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path, help="where to save results")
+    parser.add_argument("--baseline", type=Path, help="earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown to fail at")
+    parser.add_argument("--check", action="store_true", help="fail if anything regressed")
+    args = parser.parse_args()
+
+    names = [x for x in BENCHMARKS if not args.filter or any(f in x for f in args.filter)]
+    results = run(names, min_time=args.min_time, repeat=args.repeat)
+
+    output = args.output
+    if output is None:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        output = RESULTS_DIR / f"{datetime.now():%Y%m%d-%H%M%S}.json"
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "created": datetime.now().isoformat(),
+                "commit": _commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"\nSaved results to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressed = compare(results, baseline, args.threshold)
+        if regressed and args.check:
+            print(f"\n{len(regressed)} benchmark(s) regressed by more than {args.threshold}x")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ from discord.ext.commands import Bot, when_mentioned
 from dotenv import load_dotenv
 
 from db import init
+from store import store
 
 load_dotenv()
 intents = discord.Intents(messages=True, message_content=True, members=True, guilds=True)
@@ -20,6 +21,8 @@ log = logging.getLogger("bot")
 @bot.event
 async def on_ready():
     await init()
+    await store.load()
+    store.watch()
     await bot.load_extension("cogs.jsk")
     await bot.load_extension("cogs.bridge")
     await bot.load_extension("cogs.tokens")
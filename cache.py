@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, TypeVar
+
+__all__ = ("NonceTracker", "TTLCache")
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+_MISSING = object()
+
+
+class TTLCache(Generic[K, V]):
+    """A size-bounded LRU mapping whose entries are considered fresh for a set amount of time
+
+    Expired entries aren't removed until they're either overwritten or evicted to make room
+    for newer entries, which allows for callers to explicitly opt into using stale entries with
+    :meth:`get_stale` if whatever they'd normally refresh them from is unavailable.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[K, tuple[V, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key: K, default: V | None = None) -> V | None:
+        """Get the value stored for the given key, if it's present and hasn't expired"""
+        if (entry := self._data.get(key)) is None or time.monotonic() - entry[1] > self.ttl:
+            return default
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def get_stale(self, key: K, default: V | None = None) -> V | None:
+        """Get the value stored for the given key, regardless of whether it's expired"""
+        if (entry := self._data.get(key)) is None:
+            return default
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def items(self) -> list[tuple[K, V]]:
+        """Get every entry currently stored, including any that have expired"""
+        return [(k, v[0]) for k, v in self._data.items()]
+
+    def set(self, key: K, value: V) -> None:
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: K) -> V | None:
+        entry = self._data.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class NonceTracker:
+    """Nonces of messages we've sent, which are forgotten once they're either seen again or
+    have been waiting for longer than ``ttl`` seconds
+
+    Nonces are only ever expired in the order they were added, so every operation is O(1)
+    (amortized, in the case of expiry).
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._nonces: OrderedDict[str, float] = OrderedDict()
+        self.seen = 0
+        # nonces that were forgotten without ever being seen again, either due to their age
+        # or to make room for newer nonces; these likely indicate lost messages
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._nonces)
+
+    def add(self, nonce: str) -> None:
+        now = time.monotonic()
+        self._expire(now)
+        self._nonces[nonce] = now
+        # re-adding a nonce (e.g. when resending a message) has to move it to the back, as
+        # expiry stops at the first nonce that's still too new
+        self._nonces.move_to_end(nonce)
+        while len(self._nonces) > self.maxsize:
+            self._nonces.popitem(last=False)
+            self.evicted += 1
+
+    def discard(self, nonce: str) -> None:
+        self._nonces.pop(nonce, None)
+
+    def consume(self, nonce: str) -> bool:
+        """Forget the given nonce, returning whether it was being tracked"""
+        self._expire(time.monotonic())
+        if self._nonces.pop(nonce, None) is None:
+            return False
+        self.seen += 1
+        return True
+
+    def _expire(self, now: float) -> None:
+        nonces = self._nonces
+        while nonces and now - next(iter(nonces.values())) > self.ttl:
+            nonces.popitem(last=False)
+            self.expired += 1
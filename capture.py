@@ -0,0 +1,130 @@
+"""
+Opt-in recording of inbound traffic, for replaying against a local server with tools/replay.py.
+
+Set ``CAPTURE_FILE`` to enable this. Every connect, disconnect and inbound frame is appended to
+it as a single line of JSON, timestamped with the wall clock so that captures from multiple
+workers can be interleaved. Usernames, keys and the authors of messages from the bot are
+replaced with a keyed hash of themselves, which stays the same for the same user throughout a
+capture without revealing who they are; message contents are recorded as-is, so captures should
+still be treated as sensitive.
+
+Events are buffered in memory and written out from a thread every ``flush_interval`` seconds, so
+nothing here ever blocks the event loop on disk I/O.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import time
+from itertools import count
+from typing import Any
+
+import orjson
+
+__all__ = ("Capture", "capture")
+log = logging.getLogger("capture")
+
+
+class Capture:
+    def __init__(self, *, flush_interval: float = 1.0):
+        self.path: str | None = None
+        self.flush_interval = flush_interval
+        self._secret = b""
+        self._buffer: list[bytes] = []
+        self._ids = count(1)
+        self._flusher: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def load_config(self) -> None:
+        self.path = os.getenv("CAPTURE_FILE") or None
+        # a fixed secret keeps pseudonyms consistent between workers and across restarts
+        secret = os.getenv("CAPTURE_SECRET")
+        self._secret = secret.encode() if secret else secrets.token_bytes(32)
+
+    def start(self) -> None:
+        if self.enabled and (self._flusher is None or self._flusher.done()):
+            log.warning(f"Capturing all inbound traffic to {self.path}")
+            self._append({"e": "start", "t": time.time(), "pid": os.getpid()})
+            self._flusher = asyncio.get_event_loop().create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        if self._flusher:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+    def pseudonym(self, value: str) -> str:
+        return hmac.new(self._secret, value.encode(), hashlib.sha256).hexdigest()[:16]
+
+    def connected(
+        self, username: str, key: str, *, api_version: int = 1, encoding: str = "json"
+    ) -> str | None:
+        """Record a new connection, returning the id its frames should be recorded with"""
+        if not self.enabled:
+            return None
+        connection = f"{os.getpid()}.{next(self._ids)}"
+        event = {"e": "connect", "t": time.time(), "c": connection}
+        if username:
+            event.update(
+                u=self.pseudonym(username),
+                k=self.pseudonym(key),
+                v=api_version,
+                enc=encoding,
+            )
+        else:
+            # bots connect without a username, and their key is the bot key
+            event["bot"] = True
+        self._append(event)
+        return connection
+
+    def frame(self, connection: str | None, data: Any) -> None:
+        """Record a frame received from a connection, after it's been decoded"""
+        if connection is None:
+            return
+        if isinstance(data, list):
+            data = [self._anonymize(x) for x in data]
+        else:
+            data = self._anonymize(data)
+        self._append({"e": "frame", "t": time.time(), "c": connection, "d": data})
+
+    def _anonymize(self, item: Any) -> Any:
+        # frames are recorded before they're validated, so these could be just about anything
+        if isinstance(item, dict) and isinstance(item.get("author"), str):
+            return {**item, "author": self.pseudonym(item["author"])}
+        return item
+
+    def disconnected(self, connection: str | None) -> None:
+        if connection is not None:
+            self._append({"e": "disconnect", "t": time.time(), "c": connection})
+
+    def _append(self, event: dict) -> None:
+        self._buffer.append(orjson.dumps(event))
+
+    def _write(self, lines: list[bytes]) -> None:
+        with open(self.path, "ab") as f:
+            f.write(b"\n".join(lines) + b"\n")
+
+    async def flush(self) -> None:
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        try:
+            await asyncio.to_thread(self._write, lines)
+        except OSError as e:
+            log.error(f"Failed to write {len(lines)} captured events", exc_info=e)
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+capture = Capture()
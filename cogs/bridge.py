@@ -3,54 +3,304 @@ import json
 import logging
 import os
 import re
+import time
 import urllib.parse
-from collections import defaultdict
-from datetime import date
-from pathlib import Path
-from typing import Mapping, cast
+from collections import OrderedDict, deque
+from datetime import date, timedelta
+from math import ceil
+from time import monotonic
+from typing import Any, cast
 from uuid import uuid4
 
 import aiohttp
 import discord
 import websockets
+from aiohttp import web
 from discord import app_commands
 from discord.backoff import ExponentialBackoff
 from discord.ext import commands, tasks
 from pydantic import ValidationError
 
-from antispam import AntiSpam
-from common import SPAM_INTERVALS, Message, lookup_username, get_persistent_data, \
+from cache import NonceTracker
+from common import Message, RPCResult, delta_to_str, lookup_username, get_persistent_data, \
     save_persistent_data
 from db import User
+from mentions import Mentions
+from metrics import Counter, Histogram, registry
+from players import players
+from ratelimit import GCRA, limiter
+from sanitize import EMOJI, FORMAT_CODE, is_possibly_soopy, sanitizer
+from tracing import tracer
+from users import user_cache
 
 log = logging.getLogger("bot.bridge")
 WEBHOOK_LOCK = asyncio.Lock()
-EMOJI = re.compile(r"<a?(:[^:]+:)\d+>")
-USER_MENTION = re.compile(r"<@!?(\d+)>")
-CHANNEL_MENTION = re.compile(r"<#?(\d+)>")
-FORMAT_CODE = re.compile(r"§[0-9A-FK-ORZ]", re.IGNORECASE)
 USERNAME_PATTERN = re.compile(r"[a-z0-9_]{3,16}", re.IGNORECASE)
 
-# smart quotes were a mistake
-# https://stackoverflow.com/a/41516221
-QUOTE_SMART_UNQUOTE_QUOTES = dict([(ord(x), ord(y)) for x, y in zip("‘’´“”–", "'''\"\"-")])
-ALLOWED_UNICODE = set()
+# how many messages can be waiting to be sent to (or echoed back from) the server at once
+OUTBOX_SIZE = 500
+OUTBOX_BATCH = 32
+# sent messages that still haven't been echoed back after this many seconds are given up on
+ACK_TIMEOUT = 120
+# discord's documented webhook rate limit, as (limit, period); discord.py already handles 429s
+# itself, but by the time we get one we've already fallen behind
+WEBHOOK_RATE = (5, 2)
+# how many messages from the game can be waiting to be posted to discord at once
+DELIVERY_BACKLOG = 1000
+MAX_COALESCED = 10
+# how long to wait for the server to respond to an rpc call
+RPC_TIMEOUT = 10
+# how long to hold up a message waiting on its author's avatar before posting it without one
+AVATAR_TIMEOUT = 1
+
+WEBHOOK_TIME = Histogram("bot_webhook_seconds", "Time taken to post messages to Discord")
+AVATAR_TIME = Histogram("bot_avatar_lookup_seconds", "Time taken to look up player avatars")
+RECONNECTS = Counter("bot_ws_reconnects_total", "Times the bridge websocket had to reconnect")
+
+
+class RPCError(Exception):
+    """Raised when the server couldn't run an operation requested over RPC"""
+
+
+class Outbox:
+    """Messages waiting to be sent to the bridge server
+
+    Everything is written by a single task, which batches together anything queued while it was
+    busy. Sent messages are held onto until the server echoes them back to us, and are sent again
+    if the connection drops before that happens.
+    """
+
+    def __init__(self, bridge: "Bridge"):
+        self.bridge = bridge
+        # (time queued, message)
+        self.pending: deque[tuple[float, dict]] = deque()
+        self.unacked: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self.dropped = 0
+        self.expired = 0
+        self._wakeup = asyncio.Event()
+        self._connected = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._writer: asyncio.Task | None = None
+
+    @property
+    def depth(self) -> int:
+        return len(self.pending) + len(self.unacked)
+
+    def oldest(self) -> float | None:
+        """How many seconds the oldest message has been waiting to be either sent or echoed"""
+        times = []
+        if self.unacked:
+            times.append(next(iter(self.unacked.values()))[0])
+        if self.pending:
+            times.append(self.pending[0][0])
+        return monotonic() - min(times) if times else None
+
+    def start(self) -> None:
+        self._writer = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._writer:
+            self._writer.cancel()
+
+    def put(self, data: dict) -> bool:
+        """Queue a message to be sent, returning ``False`` if the queue is full"""
+        self._expire()
+        if self.depth >= OUTBOX_SIZE:
+            self.dropped += 1
+            return False
+        self.pending.append((monotonic(), data))
+        self._wakeup.set()
+        return True
+
+    def ack(self, nonce: str) -> None:
+        self.unacked.pop(nonce, None)
+
+    def disconnected(self) -> None:
+        self._connected.clear()
+
+    async def connected(self) -> None:
+        """Resend anything that wasn't echoed back before the connection was re-established,
+        and then resume sending queued messages"""
+        async with self._lock:
+            self._expire()
+            if self.unacked:
+                log.info(f"Resending {len(self.unacked)} unacknowledged messages")
+            unacked = [x[1] for x in self.unacked.values()]
+            for i in range(0, len(unacked), OUTBOX_BATCH):
+                if not await self._write(unacked[i : i + OUTBOX_BATCH]):
+                    return
+            self._connected.set()
+
+    def _expire(self) -> None:
+        now = monotonic()
+        while self.unacked and now - next(iter(self.unacked.values()))[0] > ACK_TIMEOUT:
+            nonce, _ = self.unacked.popitem(last=False)
+            log.warning(f"Message {nonce} was never echoed back by the server")
+            self.expired += 1
+
+    async def _run(self) -> None:
+        while True:
+            await self._connected.wait()
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
 
+            batch = [self.pending.popleft() for _ in range(min(len(self.pending), OUTBOX_BATCH))]
+            async with self._lock:
+                for queued, data in batch:
+                    self.unacked[data["nonce"]] = (queued, data)
+                await self._write([x[1] for x in batch])
 
-def load_allowed_unicode():
-    ALLOWED_UNICODE.clear()
-    with open(Path(__file__).parent.parent / "allowed_unicode.txt") as f:
-        for line in f.readlines():
-            line = line.replace("\n", "")
-            if line.startswith("#") or not line:
+    async def _write(self, batch: list[dict]) -> bool:
+        ws = self.bridge.ws
+        try:
+            await ws.send(json.dumps(batch[0] if len(batch) == 1 else batch))
+            for data in batch:
+                tracer.mark(data["nonce"], "bot send")
+        except websockets.ConnectionClosed:
+            # everything that was just sent is already held onto as unacknowledged, so this
+            # only needs to wait for the connection to be re-established
+            if self.bridge.ws is ws:
+                self._connected.clear()
+            return False
+        return True
+
+
+class Delivery:
+    """Messages from the game waiting to be posted to Discord, in the order they were received
+
+    Avatars are looked up concurrently as soon as a message is queued, instead of one at a time
+    right before each is posted. Posts are held back to stay within the webhook rate limit, and
+    anything that piles up in the meantime is merged into a single post.
+    """
+
+    def __init__(self, bridge: "Bridge"):
+        self.bridge = bridge
+        # (message data, formatted message, avatar lookup)
+        self.queue: deque[tuple[Message, str, asyncio.Task | None]] = deque()
+        self.posted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        # posts that failed to send, whose messages are lost
+        self.failed = 0
+        self._policy = GCRA(*WEBHOOK_RATE)
+        self._wakeup = asyncio.Event()
+        self._poster: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._poster = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._poster:
+            self._poster.cancel()
+
+    def put(self, data: Message, message: str) -> None:
+        avatar = None
+        if not data.get("system", False) and USERNAME_PATTERN.fullmatch(data["author"]):
+            avatar = asyncio.get_event_loop().create_task(self.bridge.avatar(data["author"]))
+        self.queue.append((data, message, avatar))
+        if len(self.queue) > DELIVERY_BACKLOG:
+            _, _, dropped = self.queue.popleft()
+            if dropped:
+                dropped.cancel()
+            self.dropped += 1
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            if not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
                 continue
-            ALLOWED_UNICODE.update(line)
 
+            if retry_after := self._policy.retry_after(None, monotonic()):
+                # anything queued while we wait gets merged into the same post
+                await asyncio.sleep(retry_after)
+            batch = self._take()
+            self._policy.consume(None, monotonic())
+            try:
+                await self._post(batch)
+            except Exception as e:
+                # this is the only task posting anything, so it can't be allowed to die here;
+                # cancellation isn't an Exception, and so still stops it as intended
+                log.error("Failed to send message", exc_info=e)
+                self.failed += 1
+            else:
+                self.posted += 1
+                self.coalesced += len(batch) - 1
+                # anything that never made it to discord isn't worth following up on
+                for data, message, _ in batch:
+                    if not data.get("system", False) and is_possibly_soopy(message):
+                        # noinspection PyAsyncCall
+                        self.bridge.bot.loop.create_task(
+                            self.bridge.soopy_command(message, data["author"])
+                        )
+
+    def _take(self) -> list[tuple[Message, str, asyncio.Task | None]]:
+        batch = [self.queue.popleft()]
+        if batch[0][0].get("system", False):
+            return batch
+        length = len(batch[0][0]["author"]) + len(batch[0][1]) + 8
+        while self.queue and len(batch) < MAX_COALESCED:
+            data, message, _ = self.queue[0]
+            # leave some room for markdown, and for the zwj that may be prepended to each line
+            length += len(data["author"]) + len(message) + 8
+            if data.get("system", False) or length > 2000:
+                break
+            batch.append(self.queue.popleft())
+        return batch
+
+    async def _post(self, batch: list[tuple[Message, str, asyncio.Task | None]]) -> None:
+        data, message, avatar = batch[0]
+        if data.get("system", False):
+            await self.bridge.channel.send(
+                embed=discord.Embed(description=message, colour=discord.Colour.orange())
+            )
+            tracer.mark(data["nonce"], "webhook sent")
+            return
+
+        if all(x[0]["author"] == data["author"] for x in batch):
+            username = data["author"]
+            content = "\n".join(_preserve_spaces(x[1]) for x in batch)
+            avatar_url = await self._avatar(avatar)
+            for x in batch:
+                tracer.mark(x[0]["nonce"], "avatar resolved")
+        else:
+            username = "Bridge"
+            content = "\n".join(
+                f"**{discord.utils.escape_markdown(x[0]['author'])}**: {x[1]}" for x in batch
+            )
+            avatar_url = None
+
+        webhook = await self.bridge.get_webhook()
+        start = monotonic()
+        await webhook.send(
+            content=content,
+            username=username,
+            avatar_url=avatar_url,
+            allowed_mentions=discord.AllowedMentions.none(),
+        )
+        WEBHOOK_TIME.observe(monotonic() - start)
+        for x in batch:
+            tracer.mark(x[0]["nonce"], "webhook sent")
+
+    @staticmethod
+    async def _avatar(lookup: asyncio.Task | None) -> str | None:
+        if lookup is None:
+            return None
+        await asyncio.wait({lookup}, timeout=AVATAR_TIMEOUT)
+        if not lookup.done() or lookup.cancelled() or lookup.exception():
+            return None
+        return lookup.result()
 
-def limit_character_set(string):
-    """1.8.9 is an absolutely ancient version and has no concept of a significant amount of
-    unicode characters that exist, so just strip out characters it doesn't recognize"""
-    return "".join(c for c in string if 0 < ord(c) < 127 or c in ALLOWED_UNICODE)
+
+def _preserve_spaces(message: str) -> str:
+    if message.startswith(" "):
+        # preserve spaces at the beginning of a message by adding a zwj to prevent discord
+        # from "helpfully" trimming the message
+        return f"\N{ZERO WIDTH JOINER}{message}"
+    return message
 
 
 class Bridge(commands.Cog):
@@ -58,23 +308,80 @@ class Bridge(commands.Cog):
         self.bot = bot
         self.ws: websockets.WebSocketClientProtocol = ...
         self.channel = bot.get_channel(int(os.environ["BRIDGE_CHANNEL"]))
-        self.sent: set[str] = set()
+        # nonces of messages we've sent, so that we don't send them back to Discord when
+        # they're echoed back to us
+        self.sent = NonceTracker()
+        # the nonce of the last message received, so that anything missed while reconnecting
+        # can be replayed to us
+        self.last_nonce: str | None = None
+        self.outbox = Outbox(self)
+        self.delivery = Delivery(self)
+        # rpc calls waiting on a response, keyed by their id
+        self._rpc: dict[str, asyncio.Future[RPCResult]] = {}
+        self.mentions = Mentions(
+            sanitizer.to_game,
+            lambda x: self.channel.guild.get_member(x),
+            lambda x: self.channel.guild.get_channel(x),
+        )
         self.backoff = ExponentialBackoff()
         self.backoff._max = 5
-        self.antispam: Mapping[int, AntiSpam] = defaultdict(lambda: AntiSpam(SPAM_INTERVALS))
         self.soopy_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
         self._webhook: discord.Webhook | None = None
+        self._metrics: web.AppRunner | None = None
         self.bot.loop.create_task(self.get_webhook())
 
     async def cog_unload(self) -> None:
         self.ws_handler.cancel()
+        self.outbox.stop()
+        self.delivery.stop()
         await self.ws.close()
         await self.soopy_session.close()
+        await players.close()
+        if self._metrics:
+            await self._metrics.cleanup()
+
+    async def start_metrics(self) -> None:
+        """Serve metrics for the bot at ``/metrics`` on ``BOT_METRICS_PORT``, if it's set"""
+        if not (port := os.environ.get("BOT_METRICS_PORT")):
+            return
+
+        async def handler(request: web.Request) -> web.Response:
+            if request.headers.get("bot-key") != os.environ["BOT_KEY"]:
+                return web.json_response(
+                    {"success": False, "reason": "Invalid bot key"}, status=403
+                )
+            return web.Response(text=registry.render(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handler)
+        self._metrics = web.AppRunner(app)
+        await self._metrics.setup()
+        host = os.environ.get("BOT_METRICS_HOST", "localhost")
+        await web.TCPSite(self._metrics, host, int(port)).start()
 
     async def init_ws(self):
-        self.ws = await websockets.connect(
-            f"ws://localhost:{os.environ['BRIDGE_PORT']}/bot/{os.environ['BOT_KEY']}"
-        )
+        url = f"ws://localhost:{os.environ['BRIDGE_PORT']}/bot/{os.environ['BOT_KEY']}"
+        if self.last_nonce is not None:
+            url += "?" + urllib.parse.urlencode({"resume_nonce": self.last_nonce})
+        self.ws = await websockets.connect(url)
+
+    async def rpc(self, op: str, **args) -> Any:
+        """Run an operation on the server over our websocket, instead of over HTTP
+
+        :raises RPCError: If the server couldn't run the operation
+        :raises asyncio.TimeoutError: If the server didn't respond in time
+        :raises websockets.ConnectionClosed: If we're currently disconnected from the server
+        """
+        id_ = str(uuid4())
+        self._rpc[id_] = future = asyncio.get_event_loop().create_future()
+        try:
+            await self.ws.send(json.dumps({"type": "rpc", "id": id_, "op": op, "args": args}))
+            result = await asyncio.wait_for(future, RPC_TIMEOUT)
+        finally:
+            self._rpc.pop(id_, None)
+        if not result["ok"]:
+            raise RPCError(result.get("reason"))
+        return result["result"]
 
     async def get_webhook(self) -> discord.Webhook:
         await self.bot.wait_until_ready()
@@ -105,47 +412,46 @@ class Bridge(commands.Cog):
             self._webhook = webhook = await channel.create_webhook(name="Bridge")
             log.info("Created webhook with id %s", webhook.id)
             get_persistent_data()["webhook"] = webhook.id
-            save_persistent_data()
+            await save_persistent_data()
 
             return webhook
 
     async def sub_mentions(self, message: str) -> str:
-        mentions = [*USER_MENTION.finditer(message)]
-        user_ids = {int(x.group(1)) for x in mentions}
-        linked_users = (
-            {
-                x.user_id: x.linked_account
-                async for x in User.find_many({"user_id": {"$in": [*user_ids]}})
-                if x and x.linked_account
+        linked: dict[int, str] = {}
+        if user_ids := self.mentions.user_ids(message):
+            linked = {
+                k: v.linked_account
+                for k, v in (await user_cache.get_many(user_ids)).items()
+                if v.linked_account
             }
-            if user_ids
-            else {}
-        )
+        return self.mentions.rewrite(message, linked)
 
-        for mention, uid in {str(x.group(0)): int(x.group(1)) for x in mentions}.items():
-            if uid in linked_users:
-                message = message.replace(mention, f"@{linked_users[uid]}")
-            else:
-                user = self.channel.guild.get_member(uid)
-                if user:
-                    message = message.replace(
-                        mention, f"@{limit_character_set(user.display_name) or str(user)}"
-                    )
-                else:
-                    message = message.replace(mention, "@unknown-user")
-
-        for mention in CHANNEL_MENTION.finditer(message):
-            channel_id = int(mention.group(1))
-            channel = self.channel.guild.get_channel(channel_id)
-            if channel:
-                message = message.replace(mention.group(0), f"#{limit_character_set(str(channel))}")
-            else:
-                message = message.replace(mention.group(0), "#unknown-channel")
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.display_name != after.display_name:
+            self.mentions.invalidate_member(after.id)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: discord.User, after: discord.User):
+        # display names fall back to global names, which are updated through this instead
+        if before.display_name != after.display_name:
+            self.mentions.invalidate_member(after.id)
 
-        return message
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        self.mentions.invalidate_member(member.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after: discord.abc.GuildChannel):
+        self.mentions.invalidate_channel(after.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        self.mentions.invalidate_channel(channel.id)
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
+        received = time.time()
         if (
             not get_persistent_data().get("accept_messages", True)
             or message.author.bot
@@ -155,7 +461,7 @@ class Bridge(commands.Cog):
         ):
             return
 
-        user: User | None = await User.find_one({"user_id": message.author.id})
+        user: User | None = await user_cache.get(message.author.id)
         if user and (user.is_muted or user.banned):
             if message.channel.permissions_for(message.guild.me).manage_messages:
                 await message.delete()
@@ -166,24 +472,32 @@ class Bridge(commands.Cog):
                 await Mod.remove_permissions(message.channel, message.author)
             return
 
-        antispam = self.antispam[message.author.id]
-        if antispam.spammy:
-            await message.reply("Slow down there!", mention_author=True, delete_after=3)
-            if message.channel.permissions_for(message.guild.me).manage_messages:
-                await message.delete(delay=0.5)
-            return
-
-        content = message.content.replace("\n", " ")
-        content = content.translate(QUOTE_SMART_UNQUOTE_QUOTES)
-        content = EMOJI.sub(r"\1", content)
+        if sanitizer.maybe_reload():
+            # cached names were sanitized with whatever was previously allowed
+            self.mentions.clear()
+        content = EMOJI.sub(r"\1", message.content)
         content = await self.sub_mentions(content)
         # 1.8.9 is 10 fucking years old and has no concept of any non-ASCII characters in its
-        # default font rendering, so just enforce ASCII to dodge the rendering issues entirely
-        content = limit_character_set(content)
+        # default font rendering, so just enforce ASCII to dodge the rendering issues entirely;
+        # this also folds newlines and smart quotes, all in a single pass.
+        content = sanitizer.to_game(content)
+        sanitized = time.time()
 
         if not content:
             return
-        elif len(content) > 256:
+
+        # only checked now, so that messages which end up being dropped anyways (e.g. ones that
+        # are only emojis) don't count towards the limit
+        if retry_after := limiter.hit(("author", message.author.id)):
+            wait = delta_to_str(timedelta(seconds=ceil(retry_after)))
+            await message.reply(
+                f"Slow down there! Try again in {wait}.", mention_author=True, delete_after=3
+            )
+            if message.channel.permissions_for(message.guild.me).manage_messages:
+                await message.delete(delay=0.5)
+            return
+
+        if len(content) > 256:
             await message.reply(
                 "Message was truncated to be under 256 characters long",
                 allowed_mentions=discord.AllowedMentions.none(),
@@ -193,7 +507,7 @@ class Bridge(commands.Cog):
 
         author = (
             (user and user.linked_account)
-            or limit_character_set(message.author.display_name)
+            or sanitizer.to_game(message.author.display_name)
             or str(message.author)
         )
         replying_to = message.reference.cached_message if message.reference else None
@@ -212,21 +526,21 @@ class Bridge(commands.Cog):
             else:
                 try:
                     referenced_user = (
-                        await User.find_one({"user_id": reply_author.id})
-                        if not reply_author.bot
-                        else None
+                        await user_cache.get(reply_author.id) if not reply_author.bot else None
                     )
                 except ValidationError:
                     referenced_user = None
                 author += (
                     (referenced_user and referenced_user.linked_account)
-                    or limit_character_set(reply_author.display_name)
+                    or sanitizer.to_game(reply_author.display_name)
                     or str(reply_author)
                 )
 
         nonce = str(uuid4())
-        antispam.stamp()
         self.sent.add(nonce)
+        if tracer.sampled(nonce):
+            tracer.record(nonce, "discord receive", received)
+            tracer.record(nonce, "sanitize", sanitized)
 
         data = {
             "author": f"[DISCORD] {author}",
@@ -236,8 +550,15 @@ class Bridge(commands.Cog):
         if message.flags.suppress_notifications:
             data["pings"] = False
 
-        await self.ws.send(json.dumps(data))
-        if self._is_possibly_soopy(content):
+        if not self.outbox.put(data):
+            self.sent.discard(nonce)
+            await message.reply(
+                "The bridge is currently backed up, please try again shortly.",
+                mention_author=True,
+                delete_after=5,
+            )
+            return
+        if is_possibly_soopy(content):
             if user and user.linked_account:
                 # noinspection PyAsyncCall
                 self.bot.loop.create_task(
@@ -255,118 +576,94 @@ class Bridge(commands.Cog):
         try:
             async for message in self.ws:
                 data: Message = cast(Message, json.loads(message))
+                if "type" in data:
+                    self._handle_control(data)
+                    continue
 
-                if data["nonce"] in self.sent:
-                    self.sent.discard(data["nonce"])
+                self.last_nonce = data["nonce"]
+                tracer.mark(data["nonce"], "bot receive")
+                self.outbox.ack(data["nonce"])
+                if self.sent.consume(data["nonce"]):
                     continue
 
-                message = data["message"]
-                message = FORMAT_CODE.sub("", message)
-                # this could hold up the message queue once per person for ~4 seconds every
-                # 6 hours or so; might be worth looking into shoving into a task or something
-                # in the future, but for now its probably fine.
-                try:
-                    await self._send_to_discord(data, message)
-                except discord.HTTPException as e:
-                    log.error("Failed to send message", exc_info=e)
+                self.delivery.put(data, FORMAT_CODE.sub("", data["message"]))
         except websockets.ConnectionClosedError:
+            RECONNECTS.inc()
+            self.outbox.disconnected()
             delay = self.backoff.delay()
             log.warning(f"Websocket connection closed, waiting {delay} to reconnect")
             await asyncio.sleep(delay)
             await self.init_ws()
-
-    async def _send_to_discord(self, data: Message, message: str):
-        if data.get("system", False):
-            await self.channel.send(
-                embed=discord.Embed(description=message, colour=discord.Colour.orange())
-            )
-            return
-
-        avatar: str | None = None
-        if USERNAME_PATTERN.fullmatch(data["author"]):
-            user_data = await lookup_username(data["author"], timeout=4)
-            if user_data:
-                # discord has some incredibly wacky caching which makes virtually no sense in what
-                # it caches or for how long, so just opt to add a query string parameter in an
-                # attempt to forcefully make discord disregard whatever cache it might have once
-                # per day.
-                discord_cache_bust = date.today().strftime("%y%m%d")
-                avatar = f"https://visage.surgeplay.com/face/256/{user_data['id']}?_={discord_cache_bust}"
-
-        if message.startswith(" "):
-            # preserve spaces at the beginning of a message by adding a zwj to prevent discord
-            # from "helpfully" trimming the message
-            message = f"\N{ZERO WIDTH JOINER}{message}"
-
-        webhook = await self.get_webhook()
-        await webhook.send(
-            content=message,
-            username=data["author"],
-            avatar_url=avatar,
-            allowed_mentions=discord.AllowedMentions.none(),
-        )
-
-        if self._is_possibly_soopy(message):
-            # shut up pycharm
-            # noinspection PyAsyncCall
-            self.bot.loop.create_task(self.soopy_command(message, data["author"]))
-
-    async def _send_system(self, message: str):
-        await self.ws.send(
-            json.dumps(
-                {
-                    "system": True,
-                    "author": "Bot",
-                    "message": message,
-                    # note that we don't do anything with the nonce here, unlike with other messages
-                    # we send - this is on purpose, as we want this to be echoed back for us so we
-                    # don't have to handle sending this ourselves
-                    "nonce": str(uuid4()),
-                }
-            )
-        )
+            await self.outbox.connected()
+            # missed messages are replayed to us, but cache invalidations aren't
+            user_cache.clear()
+
+    def _handle_control(self, data: dict):
+        if data["type"] == "invalidate":
+            user_cache.invalidate(data["user_id"])
+        elif data["type"] == "rpc_result":
+            if (future := self._rpc.get(data["id"])) and not future.done():
+                future.set_result(cast(RPCResult, data))
+        elif data["type"] == "ack":
+            # sent when the server already had something we resent after reconnecting
+            self.outbox.ack(data["nonce"])
+            self.sent.consume(data["nonce"])
 
     @staticmethod
-    def _is_possibly_soopy(message: str):
-        if not message.startswith("-") or message.startswith("- "):
-            return False
-
-        try:
-            # ignore messages which are simply negative numbers
-            float(message[1:].split(" ")[0])
-        except ValueError:
-            return True
-        else:
-            return False
+    async def avatar(username: str) -> str | None:
+        start = monotonic()
+        user_data = await lookup_username(username, timeout=4)
+        AVATAR_TIME.observe(monotonic() - start)
+        if not user_data:
+            return None
+        # discord has some incredibly wacky caching which makes virtually no sense in what
+        # it caches or for how long, so just opt to add a query string parameter in an
+        # attempt to forcefully make discord disregard whatever cache it might have once
+        # per day.
+        discord_cache_bust = date.today().strftime("%y%m%d")
+        return f"https://visage.surgeplay.com/face/256/{user_data['id']}?_={discord_cache_bust}"
+
+    def _send_system(self, message: str) -> bool:
+        return self.outbox.put(
+            {
+                "system": True,
+                "author": "Bot",
+                "message": message,
+                # note that we don't do anything with the nonce here, unlike with other messages
+                # we send - this is on purpose, as we want this to be echoed back for us so we
+                # don't have to handle sending this ourselves
+                "nonce": str(uuid4()),
+            }
+        )
 
     async def soopy_command(self, message: str, author: str):
-        if not self._is_possibly_soopy(message):
+        if not is_possibly_soopy(message):
             return
 
         # this can be safely echoed back as this method is only ever called once we've done some
         # basic sanitization on the message
-        await self._send_system(f"§7[SOOPY V2] {message}")
+        self._send_system(f"§7[SOOPY V2] {message}")
         try:
             command = urllib.parse.quote_plus(message[1:])
             uri = f"https://soopy.dev/api/guildBot/runCommand?user={author}&cmd={command}"
             async with self.soopy_session.get(uri) as resp:
                 data = await resp.json()
         except asyncio.TimeoutError:
-            await self._send_system("§7[SOOPY V2] Timed out waiting for a response")
+            self._send_system("§7[SOOPY V2] Timed out waiting for a response")
             return
         except aiohttp.ClientError as e:
             log.warning("Soopy guild bot API returned an error", exc_info=e)
             data = None
 
         if not data:
-            await self._send_system("§7[SOOPY V2] An error occurred while running the command")
+            self._send_system("§7[SOOPY V2] An error occurred while running the command")
             return
         if not data.get("success") or "raw" not in data:
             cause = data.get("cause", "An error occurred while running the command")
-            await self._send_system(f"§7[SOOPY V2] {cause}")
+            self._send_system(f"§7[SOOPY V2] {cause}")
             return
 
-        await self._send_system(f"§7[SOOPY V2] {data['raw']}")
+        self._send_system(f"§7[SOOPY V2] {data['raw']}")
 
     @commands.hybrid_command()
     @app_commands.guilds(discord.Object(id=int(os.environ["BRIDGE_GUILD"])))
@@ -376,18 +673,18 @@ class Bridge(commands.Cog):
             await cast(discord.InteractionResponse, ctx.interaction.response).defer(
                 ephemeral=True, thinking=True
             )
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"http://localhost:{os.environ['BRIDGE_PORT']}/online",
-                headers={"Bot-Key": os.environ["BOT_KEY"]},
-            ) as o:
-                users: dict[str, int] = await o.json()
+        try:
+            users: dict[str, int] = await self.rpc("online")
+        except (RPCError, asyncio.TimeoutError, websockets.ConnectionClosed) as e:
+            log.warning("Failed to get online users", exc_info=e)
+            await ctx.send("Couldn't reach the bridge server, please try again shortly.")
+            return
 
         if not users:
             await ctx.send("There is nobody online.")
             return
 
-        user = await User.find_one({"user_id": ctx.author.id})
+        user = await user_cache.get(ctx.author.id)
         if user and user.admin and ctx.interaction:
             online = "\n".join([f"- **{user}**: <@{id}>" for user, id in users.items()])
             await ctx.send(
@@ -420,14 +717,20 @@ class Bridge(commands.Cog):
             await ctx.send("That username doesn't exist!")
             return
         await user.set({"linked_account": data["username"]})
+        user_cache.invalidate(ctx.author.id)
         await ctx.send(f"Updated your IGN to `{user.linked_account}`")
 
 
 async def setup(bot: commands.Bot):
     # yeah this is a blocking method in an async method but whatever, its a small text file,
     # it shouldn't be that huge an issue for how often this is called.
-    load_allowed_unicode()
+    sanitizer.load()
+    tracer.load_config()
     cog = Bridge(bot)
     await cog.init_ws()
+    cog.outbox.start()
+    cog.delivery.start()
+    await cog.outbox.connected()
     cog.ws_handler.start()
+    await cog.start_metrics()
     await bot.add_cog(cog)
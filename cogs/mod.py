@@ -7,21 +7,28 @@ from pathlib import Path
 from typing import Annotated, cast
 from uuid import uuid4
 
-import aiohttp
 import discord
+import websockets
 from discord import app_commands
 from discord.ext import commands
 
-from common import get_persistent_data, save_persistent_data
-from db import User
+from common import ModResult, get_persistent_data, save_persistent_data
 from time_converter import TimeDelta
+from tracing import Stage, tracer
+from users import user_cache
 
 FORMAT_CODE = re.compile(r"&([0-9A-FK-ORZ])", re.IGNORECASE)
 
 
+def _timeline(server: dict[str, Stage], bot: dict[str, Stage]) -> list[tuple[str, str, Stage]]:
+    """Put both halves of a trace back together, in the order each stage was first reached"""
+    stages = [("server", k, v) for k, v in server.items()] + [("bot", k, v) for k, v in bot.items()]
+    return sorted(stages, key=lambda x: x[2][0])
+
+
 def bridge_admin():
     async def predicate(ctx: commands.Context):
-        user = await User.find_one({"user_id": ctx.author.id})
+        user = await user_cache.get(ctx.author.id)
         if not user or not user.admin:
             raise commands.CheckFailure()
         return True
@@ -54,14 +61,17 @@ class Mod(commands.Cog):
         )
 
     @staticmethod
-    async def _post(endpoint: str, data: dict) -> dict:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url=f"http://localhost:{os.environ['BRIDGE_PORT']}/{endpoint}",
-                json=data,
-                headers={"Bot-Key": os.environ["BOT_KEY"]},
-            ) as request:
-                return await request.json()
+    async def _call(bot: commands.Bot, op: str, **args) -> ModResult:
+        """Run a moderation operation on the server"""
+        from cogs.bridge import Bridge, RPCError
+
+        bridge_cog = cast(Bridge, bot.get_cog("Bridge"))
+        try:
+            return await bridge_cog.rpc(op, **args)
+        except RPCError as e:
+            return {"success": False, "reason": str(e)}
+        except (asyncio.TimeoutError, websockets.ConnectionClosed):
+            return {"success": False, "reason": "Couldn't reach the bridge server"}
 
     @commands.hybrid_group()
     @app_commands.guilds(discord.Object(id=int(os.environ["BRIDGE_GUILD"])))
@@ -92,7 +102,7 @@ class Mod(commands.Cog):
         message = FORMAT_CODE.sub(r"§\1", message)
         if "§" not in message:
             message = f"§6{message}"
-        await bridge_cog.ws.send(
+        queued = bridge_cog.outbox.put(
             {
                 "author": str(ctx.author),
                 "message": message,
@@ -100,7 +110,30 @@ class Mod(commands.Cog):
                 "system": True,
             }
         )
-        await ctx.send("Announcement sent!")
+        if queued:
+            await ctx.send("Announcement sent!")
+        else:
+            await ctx.send("The bridge is currently backed up, please try again shortly.")
+
+    @bridge.command()
+    @bridge_admin()
+    async def status(self, ctx: commands.Context):
+        """Show how many messages are still waiting to be sent to the server or to Discord"""
+        from cogs.bridge import Bridge
+
+        bridge_cog = cast(Bridge, ctx.bot.get_cog("Bridge"))
+        outbox, sent, delivery = bridge_cog.outbox, bridge_cog.sent, bridge_cog.delivery
+        oldest = outbox.oldest()
+        await ctx.send(
+            f"**Queued:** {len(outbox.pending)}, **awaiting echo:** {len(outbox.unacked)}"
+            f" (oldest waiting {f'{oldest:.1f}s' if oldest is not None else 'n/a'})\n"
+            f"**Dropped:** {outbox.dropped}, **never echoed:** {outbox.expired}\n"
+            f"**Echoes suppressed:** {sent.seen}, **nonces expired without an echo:**"
+            f" {sent.expired + sent.evicted}\n"
+            f"**Waiting to be posted to Discord:** {len(delivery.queue)},"
+            f" **posts:** {delivery.posted} (**merged:** {delivery.coalesced},"
+            f" **dropped:** {delivery.dropped}, **failed:** {delivery.failed})"
+        )
 
     # noinspection PyTypeHints
     @bridge.command()
@@ -121,8 +154,8 @@ class Mod(commands.Cog):
         """Temporarily mute a user"""
         await ctx.defer()
         until: datetime = datetime.utcnow() + duration
-        response = await self._post(
-            "mute", {"id": user.id, "until": until.isoformat(), "reason": reason}
+        response = await self._call(
+            ctx.bot, "mute", id=user.id, until=until.isoformat(), reason=reason
         )
         if response.get("success"):
             await ctx.send(
@@ -141,7 +174,7 @@ class Mod(commands.Cog):
     async def unmute(self, ctx: commands.Context, user: discord.User):
         """Unmute a user"""
         await ctx.defer()
-        response = await self._post("mute", {"id": user.id, "until": None})
+        response = await self._call(ctx.bot, "mute", id=user.id, until=None)
         if response.get("success"):
             await ctx.send(
                 f"\N{WHITE HEAVY CHECK MARK} {user.mention} has been unmuted.",
@@ -161,7 +194,7 @@ class Mod(commands.Cog):
     async def ban(self, ctx: commands.Context, user: discord.User, *, reason: str = None):
         """Ban a user from using the bridge"""
         await ctx.defer()
-        response = await self._post("ban", {"id": user.id, "reason": reason})
+        response = await self._call(ctx.bot, "ban", id=user.id, reason=reason)
         if response.get("success"):
             await ctx.send(
                 f"\N{WHITE HEAVY CHECK MARK} {user.mention} is now banned from using the bridge.",
@@ -182,7 +215,7 @@ class Mod(commands.Cog):
     async def unban(self, ctx: commands.Context, user: discord.User):
         """Unban a previously bridge-banned user"""
         await ctx.defer()
-        response = await self._post("unban", {"id": user.id})
+        response = await self._call(ctx.bot, "unban", id=user.id)
         if response.get("success"):
             await ctx.send(
                 f"\N{WHITE HEAVY CHECK MARK} {user.mention} has been unbanned.",
@@ -204,13 +237,55 @@ class Mod(commands.Cog):
         await ctx.defer()
         data = get_persistent_data()
         data["accept_messages"] = not data.get("accept_messages", True)
-        save_persistent_data()
-        await self._post("reload-data", {})
+        # the server picks up on this by itself, as it watches for the file being changed
+        await save_persistent_data()
         await ctx.send(
             f"\N{WHITE HEAVY CHECK MARK} The bridge is"
             f" {'no longer' if not data['accept_messages'] else 'now'} muted."
         )
 
+    @bridge.command()
+    @app_commands.describe(nonce="The message to show every stage for; defaults to recent messages")
+    @bridge_admin()
+    async def trace(self, ctx: commands.Context, nonce: str | None = None):
+        """Show where time was spent delivering recently traced messages"""
+        response = await self._call(ctx.bot, "trace", nonce=nonce, limit=10)
+        if not response.get("success"):
+            await ctx.send(f"\N{WARNING SIGN}\N{VARIATION SELECTOR-16} {response.get('reason')}")
+            return
+        if not response["sample_rate"] and not tracer.enabled:
+            await ctx.send("Tracing is disabled; set `TRACE_SAMPLE_RATE` to enable it.")
+            return
+
+        server: dict[str, dict[str, Stage]] = response["traces"]
+        if nonce is not None:
+            timeline = _timeline(server.get(nonce, {}), tracer.get(nonce) or {})
+            if not timeline:
+                await ctx.send("That message wasn't traced, or its trace has since expired.")
+                return
+            start = timeline[0][2][0]
+            lines = [
+                f"`{source:>6} | {stage:<16} | +{(first - start) * 1000:>8.1f}ms`"
+                + (f" (last +{(last - start) * 1000:.1f}ms, ×{count})" if count > 1 else "")
+                for source, stage, (first, last, count) in timeline
+            ]
+            await ctx.send(f"**Trace for `{nonce}`:**\n" + "\n".join(lines))
+            return
+
+        lines = []
+        for traced in list(dict.fromkeys([*server, *tracer.recent(10)]))[:10]:
+            timeline = _timeline(server.get(traced, {}), tracer.get(traced) or {})
+            if len(timeline) < 2:
+                continue
+            # the hop that took the longest is most likely what's at fault
+            hop = max(zip(timeline, timeline[1:]), key=lambda x: x[1][2][0] - x[0][2][0])
+            lines.append(
+                f"`{traced}`: {(timeline[-1][2][1] - timeline[0][2][0]) * 1000:.1f}ms total,"
+                f" slowest {hop[0][1]} → {hop[1][1]}"
+                f" ({(hop[1][2][0] - hop[0][2][0]) * 1000:.1f}ms)"
+            )
+        await ctx.send("\n".join(lines) or "Nothing has been traced yet.")
+
 
 async def setup(bot):
     await bot.add_cog(Mod())
@@ -1,11 +1,16 @@
+import logging
 import os
 from uuid import uuid4
 
 import discord
 from discord import app_commands
 from discord.ext import commands
+from pymongo.errors import DuplicateKeyError
 
 from db import User
+from users import user_cache
+
+log = logging.getLogger("bot.tokens")
 
 
 class Tokens(commands.Cog):
@@ -16,22 +21,39 @@ class Tokens(commands.Cog):
         """Create a new key for use with the bridge mod"""
         await ctx.defer(ephemeral=True)
 
-        user = await User.find_one({"user_id": ctx.author.id})
+        user = await user_cache.get(ctx.author.id)
         if user and user.banned:
             await ctx.send("You are banned from using the bridge!", ephemeral=True)
             return
 
-        token = uuid4()
-        # its a UUID, and the scale of this isn't intended to be very high, but still...
-        while await User.find_one({"key": token}).exists():
+        # keys are unique, so a collision (however unlikely that is with a uuid) is caught
+        # by the database instead of having to check for one beforehand
+        for _ in range(3):
             token = uuid4()
-
-        if not user:
-            await User.insert_one(User(user_id=ctx.author.id, key=str(token)))
+            try:
+                if not user:
+                    await User.insert_one(User(user_id=ctx.author.id, key=str(token)))
+                else:
+                    await user.set({"key": str(token)})
+                break
+            except DuplicateKeyError:
+                # this may also be a concurrent /apikey creating the user document first
+                user = await User.find_one({"user_id": ctx.author.id})
         else:
-            await user.set({"key": str(token)})
+            await ctx.send("Failed to create a new key, please try again.", ephemeral=True)
+            return
+        user_cache.invalidate(ctx.author.id)
         await ctx.send(f"Your new key is `{token}`", ephemeral=True)
 
+        from cogs.mod import Mod
+
+        # make sure the server stops accepting the old key
+        result = await Mod._call(ctx.bot, "invalidate", id=ctx.author.id)
+        if not result.get("success"):
+            log.warning(
+                "Failed to invalidate cached key for %s: %s", ctx.author.id, result.get("reason")
+            )
+
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(Tokens())
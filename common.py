@@ -1,14 +1,13 @@
 from __future__ import annotations
 
-import asyncio
-import json
 import logging
 from datetime import datetime, timedelta
-from typing import TypedDict, MutableMapping
+from typing import Any, TypedDict
 
-import aiohttp
 from pydantic import BaseModel
 
+from store import store
+
 __all__ = (
     "get_persistent_data",
     "load_persistent_data",
@@ -17,9 +16,13 @@ __all__ = (
     "lookup_username",
     "Message",
     "ModRequest",
+    "ModResult",
     "MuteRequest",
     "PlayerData",
+    "RPCRequest",
+    "RPCResult",
     "SPAM_INTERVALS",
+    "TraceRequest",
 )
 log = logging.getLogger("common")
 TIME_UNITS = ((60 * 60 * 24, "d"), (60 * 60, "h"), (60, "m"), (1, "s"))
@@ -28,24 +31,18 @@ SPAM_INTERVALS: list[tuple[timedelta, int]] = [
     (timedelta(seconds=10), 10),
     (timedelta(seconds=60), 40),
 ]
-USERNAME_CACHE: MutableMapping[str, tuple[PlayerData | None, datetime]] = {}
-__data = {}
 
 
 def get_persistent_data() -> PersistentData:
-    return __data
-
+    return store.data
 
-def load_persistent_data() -> None:
-    global __data
 
-    with open("data.json") as f:
-        __data = json.load(f)
+async def load_persistent_data() -> None:
+    await store.load()
 
 
-def save_persistent_data() -> None:
-    with open("data.json", mode="w") as f:
-        json.dump(__data, f)
+async def save_persistent_data() -> None:
+    await store.save()
 
 
 def delta_to_str(delta: timedelta) -> str:
@@ -85,6 +82,35 @@ class MuteRequest(ModRequest):
     until: datetime | None
 
 
+class TraceRequest(BaseModel):
+    # the most recent traces are returned if this isn't given
+    nonce: str | None = None
+    limit: int = 10
+
+
+class ModResult(TypedDict, total=False):
+    success: bool
+    reason: str
+
+
+# sent by the bot over its websocket to run one of the operations otherwise available over HTTP
+class RPCRequest(TypedDict):
+    type: str  # = "rpc"
+    id: str
+    op: str
+    args: dict[str, Any]
+
+
+# sent back to the bot in response; `ok` is only false if the operation couldn't be run at all,
+# with anything else being reported in the result the same way the HTTP endpoint would
+class RPCResult(TypedDict, total=False):
+    type: str  # = "rpc_result"
+    id: str
+    ok: bool
+    result: Any
+    reason: str
+
+
 # this isn't the entire response payload from playerdb, but it's all that we care about here.
 class PlayerData(TypedDict):
     username: str
@@ -92,27 +118,6 @@ class PlayerData(TypedDict):
 
 
 async def lookup_username(username_or_uuid: str, *, timeout: int = 10) -> PlayerData | None:
-    username_or_uuid = username_or_uuid.casefold()
-    if username_or_uuid in USERNAME_CACHE and (
-        USERNAME_CACHE[username_or_uuid][1] > datetime.utcnow() - timedelta(hours=6)
-    ):
-        return USERNAME_CACHE[username_or_uuid][0]
-
-    try:
-        uri = f"https://playerdb.co/api/player/minecraft/{username_or_uuid}"
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
-            async with session.get(uri) as resp:
-                resp.raise_for_status()
-                data = await resp.json()
-    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-        log.warning("Failed to lookup username %s", username_or_uuid, exc_info=e)
-
-    if not data or not data.get("success") or "data" not in data:
-        USERNAME_CACHE[username_or_uuid] = (None, datetime.utcnow())
-    else:
-        USERNAME_CACHE[username_or_uuid] = (data["data"]["player"], datetime.utcnow())
-
-    return USERNAME_CACHE[username_or_uuid][0]
-
-
-load_persistent_data()
+    from players import players
+
+    return await players.get(username_or_uuid, timeout=timeout)
@@ -1,27 +1,114 @@
 import asyncio
 import logging
-from datetime import datetime
+import os
+from datetime import datetime, timedelta
+from enum import Enum
+from itertools import count
+from math import ceil
+from time import monotonic
 from typing import Iterator
 from uuid import uuid4
 
-from fastapi import WebSocket
+from beanie import PydanticObjectId
+from fastapi import WebSocket, status
 
-from antispam import AntiSpam
-from common import SPAM_INTERVALS, Message, delta_to_str, get_persistent_data
+from auth import key_cache
+from common import Message, delta_to_str, get_persistent_data
 from db import User
+from fanout import Backend, LocalBackend
+from frames import Frame, encode, pack_batch, text_batch
+from governor import Governor
+from history import History
+from metrics import Counter, Gauge, Histogram
+from ratelimit import limiter
+from sanitize import sanitizer
+from tracing import tracer
 
-__all__ = ("manager", "UserConnection")
+__all__ = ("governor", "manager", "OverflowPolicy", "UserConnection", "UserState")
 log = logging.getLogger("connections")
+MAX_BATCH = 64
+
+FANOUT_TIME = Histogram(
+    "bridge_fanout_seconds", "Time spent handing a broadcast to every connection on this worker"
+)
+RECEIVE_TIME = Histogram(
+    "bridge_receive_seconds", "Time from a message being received to it being queued for broadcast"
+)
+SEND_LATENCY = Histogram(
+    "bridge_send_latency_seconds", "Time from a frame being created to it being written out"
+)
+REJECTED = Counter(
+    "bridge_rejected_messages_total", "Messages from clients that weren't broadcast", ["reason"]
+)
+DROPPED = Counter("bridge_dropped_frames_total", "Frames dropped due to a full send queue")
+
+
+class OverflowPolicy(Enum):
+    """What to do when a connection's send queue is full"""
+
+    DROP_OLDEST = "drop-oldest"
+    DROP_NEWEST = "drop-newest"
+    DISCONNECT = "disconnect"
+
+
+def _queue_config(system: bool = False) -> tuple[int, int, OverflowPolicy]:
+    if system:
+        # everything headed to discord goes through the bot's queue, so it's unbounded by
+        # default; dropping from it loses messages for everyone, and disconnecting it is worse
+        size = int(os.getenv("BOT_SEND_QUEUE_SIZE", 0))
+        high_water = int(os.getenv("BOT_SEND_QUEUE_HIGH_WATER", max(size // 2, 1000)))
+        return size, high_water, OverflowPolicy.DROP_OLDEST
+    size = int(os.getenv("SEND_QUEUE_SIZE", 256))
+    # an unbounded queue (i.e. a size of 0) still needs some point at which it's lagging
+    high_water = int(os.getenv("SEND_QUEUE_HIGH_WATER", size // 2 if size else 128))
+    policy = OverflowPolicy(os.getenv("SEND_QUEUE_POLICY", OverflowPolicy.DROP_OLDEST.value))
+    return size, high_water, policy
+
+
+class UserState:
+    """State shared between every connection belonging to the same user"""
+
+    __slots__ = ("user", "connections")
+
+    def __init__(self, user: User):
+        self.user = user
+        self.connections: set[UserConnection] = set()
 
 
 class UserConnection:
-    def __init__(self, user: str, ws: WebSocket, *, system: bool = False, user_data: User = None):
+    # ids are reused once an object is garbage collected, so these are used to tell apart
+    # connections that may otherwise end up sharing state with one that's long since closed
+    _tokens = count(1)
+
+    def __init__(
+        self,
+        user: str,
+        ws: WebSocket,
+        *,
+        system: bool = False,
+        user_data: User = None,
+        api_version: int = 1,
+        encoding: str = "json",
+    ):
         self.user = user
         self.ws = ws
         self.system = system
-        self.user_data = user_data
-        self.antispam = AntiSpam(SPAM_INTERVALS)
-        self.send_queue: asyncio.Queue[Message] = asyncio.Queue()
+        self.token = next(self._tokens)
+        self.api_version = api_version
+        self.encoding = encoding
+        # API v2 clients get any messages that arrive in quick succession batched into
+        # a single frame
+        self.batch_window = int(os.getenv("BATCH_WINDOW_MS", 5)) / 1000
+        # this gets swapped out for the state shared with any other connections from the same
+        # user once connected
+        self.state: UserState | None = UserState(user_data) if user_data else None
+        # queued messages are already encoded, so that a broadcast is only serialized once
+        # regardless of how many connections it's being sent to
+        queue_size, self.high_water, self.overflow_policy = _queue_config(system)
+        self.send_queue: asyncio.Queue[Frame] = asyncio.Queue(maxsize=queue_size)
+        # how many messages this connection has missed out on because its queue was full
+        self.dropped = 0
+        self._overflow_disconnect: asyncio.Task | None = None
         # you are wrong pycharm, now be quiet
         # noinspection PyUnreachableCode
         self.queue_dispatcher = asyncio.get_event_loop().create_task(self._dispatch_queue())
@@ -29,12 +116,58 @@ class UserConnection:
     async def _dispatch_queue(self) -> None:
         while True:
             try:
-                await self.send_json(await self.send_queue.get())
+                frames = [await self.send_queue.get()]
+                if self.api_version >= 2:
+                    # only wait around for more if there's already more than one message queued,
+                    # so that lone messages don't incur any extra latency
+                    if self.batch_window and not self.send_queue.empty():
+                        await asyncio.sleep(self.batch_window)
+                    while len(frames) < MAX_BATCH and not self.send_queue.empty():
+                        frames.append(self.send_queue.get_nowait())
+                if tracer.enabled:
+                    for frame in frames:
+                        if frame.traced:
+                            tracer.record(frame.nonce, "dequeue")
+                await self._write(frames)
             except asyncio.CancelledError:
                 return
             except Exception as e:
                 log.error("Failed to send queued message", exc_info=e)
 
+    def enqueue(self, frame: Frame) -> None:
+        """Queue a frame to be sent, applying the overflow policy if the queue is full"""
+        try:
+            self.send_queue.put_nowait(frame)
+            return
+        except asyncio.QueueFull:
+            pass
+
+        self.dropped += 1
+        DROPPED.inc()
+        if self.overflow_policy is OverflowPolicy.DROP_OLDEST:
+            self.send_queue.get_nowait()
+            self.send_queue.put_nowait(frame)
+        elif self.overflow_policy is OverflowPolicy.DISCONNECT and not self._overflow_disconnect:
+            log.warning("Disconnecting %r as its send queue is full", self.user or "bot")
+            # there's no sense in trying to flush whatever's still queued to a client that
+            # isn't keeping up anyways
+            self.queue_dispatcher.cancel()
+            self._overflow_disconnect = asyncio.get_event_loop().create_task(
+                self.disconnect(
+                    code=status.WS_1013_TRY_AGAIN_LATER, reason="Too many messages queued"
+                )
+            )
+
+    @property
+    def lagging(self) -> bool:
+        """Whether this connection's send queue is at or above the high-water mark"""
+        # a high-water mark of 0 turns this off entirely, rather than everything always lagging
+        return 0 < self.high_water <= self.send_queue.qsize()
+
+    @property
+    def user_data(self) -> User | None:
+        return self.state.user if self.state else None
+
     def is_muted(self) -> bool:
         return self.user_data and self.user_data.is_muted
 
@@ -47,62 +180,296 @@ class UserConnection:
         )
 
     async def send_json(self, data: dict):
-        await self.ws.send_json(data)
+        await self._write([Frame.from_data(data)])
+
+    async def _write(self, frames: list[Frame]):
+        if self.api_version < 2:
+            for frame in frames:
+                await self.ws.send_text(frame.text)
+        elif self.encoding == "msgpack":
+            await self.ws.send_bytes(pack_batch(frames))
+        else:
+            await self.ws.send_text(text_batch(frames))
+        now = monotonic()
+        for frame in frames:
+            SEND_LATENCY.observe(now - frame.created)
+            if frame.traced:
+                tracer.record(frame.nonce, "write")
 
     # noinspection PyShadowingBuiltins
     async def handle_ws_request(self, type: str, data: dict):
         if type == "send":
-            message: str = data["data"]
+            received = monotonic()
+            nonce = str(data.get("nonce") or uuid4())
+            if traced := tracer.sampled(nonce):
+                tracer.record(nonce, "receive")
+            message = sanitizer.from_game(data["data"])
+            if traced:
+                tracer.record(nonce, "sanitize")
             if not message.replace(" ", ""):
                 return
 
             if not get_persistent_data().get("accept_messages", True) and not self.user_data.admin:
-                await self.send_system(f"§cThe bridge is currently muted.")
+                REJECTED.inc(reason="bridge_muted")
+                await self.send_system("§cThe bridge is currently muted.")
                 return
 
             if self.is_muted():
                 duration = delta_to_str(self.user_data.muted_until - datetime.utcnow())
                 reason = self.user_data.mute_reason or "No reason specified"
+                REJECTED.inc(reason="muted")
                 await self.send_system(f"§cYou are muted for {duration}:§r {reason}")
                 return
 
-            if self.antispam.spammy:
-                await self.send_system(f"§cSlow down there!", author="System")
+            retry_after = limiter.hit(
+                ("global", None), ("user", self.user_data.id), ("connection", self.token)
+            )
+            if retry_after:
+                REJECTED.inc(reason="rate_limit")
+                wait = delta_to_str(timedelta(seconds=ceil(retry_after)))
+                await self.send_system(f"§cSlow down there! Try again in {wait}.", author="System")
                 return
-            self.antispam.stamp()
 
-            await self._broadcast(self.user, str(data["data"]), nonce=data.get("nonce"))
+            # noinspection PyArgumentList
+            if not await governor.submit(Message(author=self.user, message=message, nonce=nonce)):
+                REJECTED.inc(reason="busy")
+                await self.send_system("§cChat is too busy right now, please try again shortly.")
+                return
+            RECEIVE_TIME.observe(monotonic() - received)
 
         elif type == "request_online":
-            connected = {x.user for x in manager.active_connections if not x.system}
-            await self.send_system("§aOnline:§r " + ", ".join(connected))
-
-    @staticmethod
-    async def _broadcast(user: str, message: str, *, nonce: str = None):
-        # noinspection PyArgumentList
-        await manager.broadcast(Message(author=user, message=message, nonce=str(nonce or uuid4())))
+            await self.send_system("§aOnline:§r " + ", ".join(manager.online()))
 
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: list[UserConnection] = []
+        self.active_connections: set[UserConnection] = set()
+        # connections indexed by the id of their user document, and by their in-game username;
+        # system connections (i.e. the bot) are only ever present in active_connections.
+        self.users: dict[PydanticObjectId, UserState] = {}
+        self.by_name: dict[str, set[UserConnection]] = {}
+        self.bots: set[UserConnection] = set()
+        # everything broadcast goes through the fan-out backend, so that it also reaches
+        # connections on any other workers
+        self.backend: Backend = LocalBackend()
+        self.worker_id = uuid4().hex
+        # the usernames online on every other worker, keyed by their worker id
+        self.remote_online: dict[str, dict[str, int]] = {}
+        # recently delivered frames, for replaying to clients that reconnect
+        self.history = History()
+
+    async def start(self, backend: Backend):
+        self.history = History(
+            maxlen=int(os.getenv("HISTORY_SIZE", 1000)),
+            max_age=float(os.getenv("HISTORY_MAX_AGE", 300)),
+        )
+        self.backend = backend
+        await backend.start(self)
 
-    async def connect(self, user: UserConnection):
+    async def stop(self):
+        await self.backend.stop()
+
+    async def connect(
+        self,
+        user: UserConnection,
+        *,
+        resume_after: int | None = None,
+        resume_nonce: str | None = None,
+    ):
         await user.ws.accept()
-        self.active_connections.append(user)
+        self.active_connections.add(user)
+        # this has to happen before anything else is awaited, so that nothing delivered in the
+        # meantime ends up either missing or sent twice
+        if resume_nonce is not None:
+            self._replay(user, self.history.after_nonce(resume_nonce))
+        elif resume_after is not None:
+            self._replay(user, self.history.after(resume_after))
+        if user.system:
+            self.bots.add(user)
+            return
+
+        if state := self.users.get(user.user_data.id):
+            # whatever was just loaded from the database is the most up-to-date copy
+            state.user = user.user_data
+            user.state = state
+        else:
+            self.users[user.user_data.id] = user.state
+        user.state.connections.add(user)
+        if user.user not in self.by_name:
+            self.by_name[user.user] = set()
+            await self.publish(
+                {
+                    "type": "join",
+                    "worker": self.worker_id,
+                    "name": user.user,
+                    "user_id": user.user_data.user_id,
+                }
+            )
+        self.by_name[user.user].add(user)
 
-    def disconnect(self, user: UserConnection):
-        self.active_connections.remove(user)
+    def _replay(self, user: UserConnection, frames: list[Frame]) -> None:
+        if frames:
+            log.debug(f"Replaying {len(frames)} missed messages to {user.user}")
+        for frame in frames:
+            user.enqueue(frame)
+
+    async def disconnect(self, user: UserConnection):
+        self.active_connections.discard(user)
         user.queue_dispatcher.cancel()
+        limiter.forget("connection", user.token)
+        if user.system:
+            self.bots.discard(user)
+            return
+
+        user.state.connections.discard(user)
+        if not user.state.connections and self.users.get(user.user_data.id) is user.state:
+            del self.users[user.user_data.id]
+        if (named := self.by_name.get(user.user)) is not None:
+            named.discard(user)
+            if not named:
+                del self.by_name[user.user]
+                await self.publish({"type": "leave", "worker": self.worker_id, "name": user.user})
 
     async def broadcast(self, message: Message):
+        await self.broadcast_frame(encode(message), message)
+
+    async def broadcast_frame(self, frame: str, data: dict | None = None):
+        """Send an already encoded frame to all connections on every worker as-is
+
+        ``data`` is the decoded frame, if it's at hand, which saves decoding it again here.
+        """
+        await self.backend.publish_frame(frame, data)
+
+    async def publish(self, event: dict):
+        """Publish a control event to every worker, including this one"""
+        await self.backend.publish(event)
+
+    def deliver(self, frame: str, data: dict | None = None) -> None:
+        # this is shared between every connection, so that it's only ever encoded with
+        # msgpack once, if at all
+        start = monotonic()
+        shared = self.history.record(frame, data)
+        if tracer.sampled(shared.nonce):
+            shared.traced = True
+            tracer.record(shared.nonce, "broadcast")
         for user in self.active_connections:
-            user.send_queue.put_nowait(message)
+            user.enqueue(shared)
+        FANOUT_TIME.observe(monotonic() - start)
 
-    def all_from(self, user: User) -> Iterator[UserConnection]:
-        for connection in self.active_connections:
-            if connection.user_data and connection.user_data.id == user.id:
-                yield connection
+    def notify_bots(self, data: dict) -> None:
+        """Send a control message to any bots connected to this worker"""
+        if self.bots:
+            frame = Frame.from_data(data)
+            for bot in self.bots:
+                bot.enqueue(frame)
+
+    async def resync(self) -> None:
+        # anything we knew about other workers may be out of date by now, so start over and
+        # have every other worker tell us who's connected to them
+        self.remote_online.clear()
+        await self.publish({"type": "hello", "worker": self.worker_id})
+
+    async def handle_event(self, event: dict) -> None:
+        type_ = event["type"]
+        worker = event.get("worker")
+        if type_ == "hello" and worker != self.worker_id:
+            await self.publish(
+                {"type": "roster", "worker": self.worker_id, "online": self.local_online()}
+            )
+        elif type_ == "roster" and worker != self.worker_id:
+            self.remote_online[worker] = event["online"]
+        elif type_ == "join" and worker != self.worker_id:
+            self.remote_online.setdefault(worker, {})[event["name"]] = event["user_id"]
+        elif type_ == "leave" and worker != self.worker_id:
+            self.remote_online.get(worker, {}).pop(event["name"], None)
+        elif type_ == "gone":
+            self.remote_online.pop(worker, None)
+        elif type_ in ("invalidate", "ban", "mute"):
+            # any changes to a user also invalidate the bot's own cached copy
+            key_cache.invalidate(event["user_id"])
+            self.notify_bots({"type": "invalidate", "user_id": event["user_id"]})
+
+        if type_ == "ban":
+            reason = event["reason"] or "No reason specified"
+            for connection in self.all_from(PydanticObjectId(event["user"])):
+                # any one connection may already be closing, which shouldn't stop the rest
+                try:
+                    await connection.send_system(f"§cYou have been banned:§r {reason}")
+                    await connection.disconnect(reason="You have been banned", code=1008)
+                except Exception as e:
+                    log.warning(f"Failed to disconnect banned user {connection.user}", exc_info=e)
+        elif type_ == "mute":
+            await self._apply_mute(
+                PydanticObjectId(event["user"]),
+                datetime.fromisoformat(event["until"]) if event["until"] else None,
+                event["reason"],
+            )
+
+    async def _apply_mute(self, user_id: PydanticObjectId, until: datetime | None, reason: str):
+        if not (state := self.users.get(user_id)):
+            return
+
+        state.user.muted_until = until
+        state.user.mute_reason = reason
+        reason = reason or "No reason specified"
+        if state.user.is_muted:
+            duration = delta_to_str(until - datetime.utcnow())
+            message = f"§cYou have been muted for {duration}:§r {reason}"
+        else:
+            message = "§bYou have been unmuted."
+        for connection in self.all_from(user_id):
+            try:
+                await connection.send_system(message)
+            except Exception as e:
+                log.warning(f"Failed to notify {connection.user} of their mute", exc_info=e)
+
+    def lagging(self) -> list[UserConnection]:
+        """Get all connections whose send queue is currently over the high-water mark"""
+        return [x for x in self.active_connections if x.lagging]
+
+    def all_from(self, user_id: PydanticObjectId) -> Iterator[UserConnection]:
+        """Get every connection on this worker belonging to the given user"""
+        if state := self.users.get(user_id):
+            # copied, as callers may very well end up disconnecting these connections
+            yield from [*state.connections]
+
+    def local_online(self) -> dict[str, int]:
+        return {
+            name: next(iter(connections)).user_data.user_id
+            for name, connections in self.by_name.items()
+        }
+
+    def online(self) -> dict[str, int]:
+        """Get the Discord user ID for every username currently connected to any worker"""
+        online = self.local_online()
+        for remote in self.remote_online.values():
+            online.update(remote)
+        return online
 
 
 manager = ConnectionManager()
+governor = Governor(manager.broadcast)
+
+
+def _connections() -> dict[tuple[str, ...], int]:
+    counts = {}
+    for connection in manager.active_connections:
+        key = ("bot",) if connection.system else (str(connection.api_version),)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def _queue_depths() -> dict[tuple[str, ...], float]:
+    depths = [x.send_queue.qsize() for x in manager.active_connections]
+    return {
+        ("max",): max(depths, default=0),
+        ("mean",): sum(depths) / len(depths) if depths else 0,
+        ("total",): sum(depths),
+        ("lagging",): len(manager.lagging()),
+    }
+
+
+Gauge("bridge_connections", "Open connections", ["api_version"], collect=_connections)
+Gauge(
+    "bridge_send_queue_depth", "Frames queued across connections", ["stat"], collect=_queue_depths
+)
@@ -1,13 +1,33 @@
+import logging
 import os
 from datetime import datetime
 
-from beanie import Document, init_beanie
+from beanie import Document, Indexed, init_beanie
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+from pymongo.errors import OperationFailure
+
+from metrics import Histogram
+
+log = logging.getLogger("db")
+MONGO_TIME = Histogram("bridge_mongo_seconds", "Time taken by database commands", ["command"])
+
+
+class _CommandTimer(monitoring.CommandListener):
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        MONGO_TIME.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        MONGO_TIME.observe(event.duration_micros / 1e6, command=event.command_name)
 
 
 class User(Document):
-    key: str
-    user_id: int
+    # these are what users are looked up by on every connection and every discord message
+    key: Indexed(str, unique=True)
+    user_id: Indexed(int, unique=True)
     admin: bool = False
     banned: bool = False
     ban_reason: str | None = None
@@ -22,4 +42,12 @@ class User(Document):
 
 async def init():
     host = os.environ.get("MONGO_HOST", "mongodb://localhost:27017")
-    await init_beanie(database=AsyncIOMotorClient(host)["swsh-bridge"], document_models=[User])
+    database = AsyncIOMotorClient(host, event_listeners=[_CommandTimer()])["swsh-bridge"]
+    try:
+        # this creates any indexes declared above that don't already exist
+        await init_beanie(database=database, document_models=[User])
+    except OperationFailure as e:
+        # most likely duplicate keys or user ids from before these were unique; run
+        # tools/check_indexes.py to find them
+        log.error("Failed to create indexes, continuing without them", exc_info=e)
+        await init_beanie(database=database, document_models=[User], skip_indexes=True)
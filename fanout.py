@@ -0,0 +1,234 @@
+"""
+Backends for fanning messages out between server workers.
+
+Everything published through a backend is delivered to every worker, including the worker
+that published it; this is what allows the server to be run with multiple workers
+(e.g. ``uvicorn --workers 4``) while still having every connected client receive every message.
+
+Two kinds of payloads are supported: pre-encoded websocket frames, which are passed through
+as-is, and control events (plain JSON-compatible dicts) used for keeping worker state
+such as the online roster in sync, and for moderation actions.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import fcntl
+import logging
+import os
+import struct
+from typing import Protocol
+
+import orjson
+
+__all__ = ("Backend", "Handler", "LocalBackend", "UnixSocketBackend", "from_env")
+log = logging.getLogger("fanout")
+
+# every packet on the unix socket bus is a length-prefixed payload with a single byte for its kind
+_HEADER = struct.Struct(">IB")
+_FRAME = 0
+_EVENT = 1
+# peers that fall this far behind on reading get dropped, and have to reconnect
+_MAX_BUFFERED = 16 * 1024 * 1024
+
+
+class Handler(Protocol):
+    def deliver(self, frame: str, data: dict | None = None) -> None:
+        """Send a frame to every connection on this worker
+
+        ``data`` is the frame before it was encoded, if it was published from this worker.
+        """
+
+    async def handle_event(self, event: dict) -> None:
+        """Handle a control event published by any worker"""
+
+    async def resync(self) -> None:
+        """Called whenever this worker (re)joins the bus and may have missed events"""
+
+
+class Backend:
+    def __init__(self):
+        self.handler: Handler | None = None
+
+    async def start(self, handler: Handler) -> None:
+        self.handler = handler
+        await handler.resync()
+
+    async def stop(self) -> None:
+        pass
+
+    async def publish_frame(self, frame: str, data: dict | None = None) -> None:
+        raise NotImplementedError
+
+    async def publish(self, event: dict) -> None:
+        raise NotImplementedError
+
+
+class LocalBackend(Backend):
+    """Backend for running as a single worker; everything is simply delivered in-process"""
+
+    async def publish_frame(self, frame: str, data: dict | None = None) -> None:
+        self.handler.deliver(frame, data)
+
+    async def publish(self, event: dict) -> None:
+        await self.handler.handle_event(event)
+
+
+class UnixSocketBackend(Backend):
+    """Backend connecting workers on the same machine over a unix socket
+
+    Whichever worker grabs the lock file first becomes the hub, which every other worker
+    connects to, and which relays everything it receives to every other worker. If the hub
+    goes away, the remaining workers elect a new one amongst themselves.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._lock_fd: int | None = None
+        self._server: asyncio.Server | None = None
+        # peers connected to us while we're the hub, along with the worker id they announced
+        self._peers: dict[asyncio.StreamWriter, str | None] = {}
+        self._hub: asyncio.StreamWriter | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def is_hub(self) -> bool:
+        return self._server is not None
+
+    async def start(self, handler: Handler) -> None:
+        self.handler = handler
+        self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+        if self._server:
+            self._server.close()
+            self._server = None
+            for writer in self._peers:
+                writer.close()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _try_lock(self) -> bool:
+        fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    async def _run(self) -> None:
+        delay = 0.1
+        while True:
+            if self._try_lock():
+                await self._serve()
+                return
+
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                # the hub might not be listening just yet
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+                continue
+
+            delay = 0.1
+            self._hub = writer
+            log.info("Connected to fan-out hub at %s", self.path)
+            try:
+                await self.handler.resync()
+                await self._read(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                log.warning("Lost connection to fan-out hub, attempting to reconnect")
+            finally:
+                self._hub = None
+                writer.close()
+
+    async def _serve(self) -> None:
+        # we hold the lock, so anything still at this path is left over from a previous hub
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._accept, self.path)
+        log.info("Acting as fan-out hub on %s", self.path)
+        await self.handler.resync()
+        await self._server.serve_forever()
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._peers[writer] = None
+        try:
+            await self._read(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # a cancellation here only ever means that we're shutting down
+            pass
+        finally:
+            worker = self._peers.pop(writer, None)
+            writer.close()
+            if worker is not None:
+                await self.publish({"type": "gone", "worker": worker})
+
+    async def _read(
+        self, reader: asyncio.StreamReader, origin: asyncio.StreamWriter | None = None
+    ) -> None:
+        while True:
+            header = await reader.readexactly(_HEADER.size)
+            length, kind = _HEADER.unpack(header)
+            payload = await reader.readexactly(length)
+            if origin is not None:
+                self._relay(header + payload, exclude=origin)
+
+            # nothing that goes wrong handling a single packet should ever take down the link
+            # with the bus, as this worker would otherwise stop receiving anything from it
+            try:
+                if kind == _FRAME:
+                    self.handler.deliver(payload.decode())
+                elif kind == _EVENT:
+                    event = orjson.loads(payload)
+                    if origin is not None and event.get("type") == "hello":
+                        self._peers[origin] = event["worker"]
+                    await self.handler.handle_event(event)
+            except Exception as e:
+                log.error("Failed to handle fan-out packet", exc_info=e)
+
+    def _relay(self, packet: bytes, *, exclude: asyncio.StreamWriter | None = None) -> None:
+        if self.is_hub:
+            writers = [x for x in self._peers if x is not exclude]
+        elif self._hub is not None:
+            writers = [self._hub]
+        else:
+            # we're between hubs; this will only reach connections on this worker
+            writers = []
+
+        for writer in writers:
+            if writer.transport.get_write_buffer_size() > _MAX_BUFFERED:
+                log.warning("Dropping fan-out peer as it isn't keeping up")
+                writer.close()
+                continue
+            writer.write(packet)
+
+    async def publish_frame(self, frame: str, data: dict | None = None) -> None:
+        payload = frame.encode()
+        self._relay(_HEADER.pack(len(payload), _FRAME) + payload)
+        self.handler.deliver(frame, data)
+
+    async def publish(self, event: dict) -> None:
+        payload = orjson.dumps(event)
+        self._relay(_HEADER.pack(len(payload), _EVENT) + payload)
+        await self.handler.handle_event(event)
+
+
+def from_env() -> Backend:
+    """Create the fan-out backend configured with ``FANOUT_BACKEND``"""
+    backend = os.getenv("FANOUT_BACKEND", "local")
+    if backend == "local":
+        return LocalBackend()
+    elif backend == "unix":
+        return UnixSocketBackend(os.getenv("FANOUT_SOCKET", "bridge-fanout.sock"))
+    raise ValueError(f"Unknown fan-out backend {backend!r}")
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import struct
+from time import monotonic
+
+import msgpack
+import orjson
+
+__all__ = ("Frame", "decode", "encode", "pack_batch", "text_batch")
+
+
+def encode(data: dict) -> str:
+    """Serialize a payload into the text frame that gets written to every connection
+
+    This is done exactly once per broadcast, instead of once per connection like
+    ``WebSocket.send_json`` would do.
+    """
+    return orjson.dumps(data).decode()
+
+
+class Frame:
+    """A single message, encoded at most once per encoding no matter how many connections
+    it ends up being sent to"""
+
+    __slots__ = ("text", "created", "nonce", "traced", "seq", "_data", "_packed", "_sequenced")
+
+    def __init__(self, text: str, data: dict | None = None):
+        self.text = text
+        # for measuring how long it takes to actually get written to each connection
+        self.created = monotonic()
+        self.nonce: str | None = data.get("nonce") if data is not None else None
+        # whether this frame's nonce is sampled for tracing, so that this is only worked out
+        # once rather than for every connection it's sent to
+        self.traced = False
+        # assigned by the history this frame is recorded in, and only ever sent to API v2
+        # clients; everyone else gets the frame exactly as it was broadcast
+        self.seq: int | None = None
+        self._data = data
+        self._packed: bytes | None = None
+        self._sequenced: str | None = None
+
+    @classmethod
+    def from_data(cls, data: dict) -> Frame:
+        return cls(encode(data), data)
+
+    @property
+    def sequenced(self) -> str:
+        """This frame's text, with its sequence number (if any) included as ``seq``"""
+        if self.seq is None:
+            return self.text
+        if self._sequenced is None:
+            if self._data is not None and "seq" in self._data:
+                # this can't just be spliced in without ending up with the key twice
+                self._sequenced = encode({**self._data, "seq": self.seq})
+            else:
+                # avoid re-encoding the entire frame just to tack on a single key
+                rest = self.text.lstrip()[1:].lstrip()
+                self._sequenced = (
+                    f'{{"seq":{self.seq}' + ("" if rest.startswith("}") else ",") + rest
+                )
+        return self._sequenced
+
+    @property
+    def packed(self) -> bytes:
+        """This frame encoded with MessagePack, including its sequence number (if any)"""
+        if self._packed is None:
+            # frames forwarded from other workers are only ever given to us as text, so this
+            # has to be decoded first; this is still only done once per frame.
+            data = self._data if self._data is not None else orjson.loads(self.text)
+            if self.seq is not None:
+                data = {**data, "seq": self.seq}
+            self._packed = msgpack.packb(data)
+        return self._packed
+
+
+def text_batch(frames: list[Frame]) -> str:
+    """Join several frames into a single JSON array, without re-encoding any of them"""
+    return f"[{','.join(x.sequenced for x in frames)}]"
+
+
+def pack_batch(frames: list[Frame]) -> bytes:
+    """Join several frames into a single MessagePack array, without re-encoding any of them"""
+    count = len(frames)
+    if count < 16:
+        header = bytes((0x90 | count,))
+    elif count < 0x10000:
+        header = b"\xdc" + struct.pack(">H", count)
+    else:
+        header = b"\xdd" + struct.pack(">I", count)
+    return header + b"".join(x.packed for x in frames)
+
+
+def decode(text: str | None = None, data: bytes | None = None) -> list[dict]:
+    """Decode a frame received from an API v2 client
+
+    Clients may send either a single request or an array of requests, encoded as either JSON
+    in a text frame or MessagePack in a binary frame.
+    """
+    decoded = msgpack.unpackb(data) if data is not None else orjson.loads(text)
+    if isinstance(decoded, list):
+        return [x for x in decoded if isinstance(x, dict)]
+    return [decoded] if isinstance(decoded, dict) else []
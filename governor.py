@@ -0,0 +1,153 @@
+"""
+Server-wide admission control for chat messages.
+
+Every player's messages are individually rate limited, but a flood from many accounts at
+once can still add up to far more than anyone can read, while multiplying into a queued frame
+for every single connection. The governor caps how many chat messages per second get broadcast
+in total, and applies backpressure once that's exceeded in one of the following ways:
+
+- ``delay``: hold messages until there's room for them, up to ``max_delay`` seconds
+- ``coalesce``: merge messages from the same author that arrive while over the limit
+- ``reject``: drop the message, and let the sender know
+
+This is configured with the ``broadcast_governor`` key in the persistent data file:
+
+.. code-block:: json
+
+    {"broadcast_governor": {"rate": 20, "burst": 40, "mode": "delay", "max_delay": 2}}
+
+The governor can be disabled by setting this key to ``null``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from time import monotonic
+from typing import Awaitable, Callable
+
+from common import Message, get_persistent_data
+from ratelimit import GCRA
+
+__all__ = ("Governor",)
+log = logging.getLogger("governor")
+
+DEFAULT_CONFIG = {"rate": 20, "burst": 40, "mode": "delay", "max_delay": 2.0}
+# coalesced messages are capped to the same length as messages sent from Discord
+MAX_COALESCED_LENGTH = 256
+MAX_PENDING = 100
+_UNSET = object()
+
+
+class Governor:
+    def __init__(self, send: Callable[[Message], Awaitable[None]]):
+        self.send = send
+        self.admitted = 0
+        self.delayed = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self._config = _UNSET
+        self._policy: GCRA | None = None
+        self.mode = DEFAULT_CONFIG["mode"]
+        self.max_delay = DEFAULT_CONFIG["max_delay"]
+        # messages held while coalescing, keyed by their author
+        self._pending: dict[str, Message] = {}
+        self._flusher: asyncio.Task | None = None
+
+    def _refresh(self) -> None:
+        config = get_persistent_data().get("broadcast_governor", DEFAULT_CONFIG)
+        if config is self._config:
+            return
+
+        self._config = config
+        if config is None:
+            self._policy = None
+            return
+        try:
+            self._configure(config)
+        except (KeyError, TypeError, ZeroDivisionError) as e:
+            log.error("Invalid governor configuration, using the defaults instead", exc_info=e)
+            self._configure(DEFAULT_CONFIG)
+
+    def _configure(self, config: dict) -> None:
+        self._policy = GCRA(limit=config["rate"], period=1, burst=config.get("burst"))
+        self.mode = config.get("mode", DEFAULT_CONFIG["mode"])
+        self.max_delay = config.get("max_delay", DEFAULT_CONFIG["max_delay"])
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "admitted": self.admitted,
+            "delayed": self.delayed,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "pending": len(self._pending),
+        }
+
+    async def submit(self, message: Message) -> bool:
+        """Broadcast a chat message once the governor allows for it
+
+        Returns ``False`` if the message was rejected outright.
+        """
+        self._refresh()
+        if self._policy is None:
+            self.admitted += 1
+            await self.send(message)
+            return True
+
+        now = monotonic()
+        retry_after = self._policy.retry_after(None, now)
+        if not retry_after and not self._pending:
+            self._policy.consume(None, now)
+            self.admitted += 1
+            await self.send(message)
+            return True
+
+        if self.mode == "delay" and retry_after <= self.max_delay:
+            # the slot is reserved right away, so that anything arriving after this
+            # has to wait behind it
+            self._policy.consume(None, now)
+            self.delayed += 1
+            await asyncio.sleep(retry_after)
+            await self.send(message)
+            return True
+        elif self.mode == "coalesce":
+            return self._coalesce(message)
+
+        self.rejected += 1
+        return False
+
+    def _coalesce(self, message: Message) -> bool:
+        author = message["author"]
+        if pending := self._pending.get(author):
+            merged = f"{pending['message']} | {message['message']}"
+            if len(merged) > MAX_COALESCED_LENGTH:
+                self.rejected += 1
+                return False
+            pending["message"] = merged
+            self.coalesced += 1
+        elif len(self._pending) >= MAX_PENDING:
+            self.rejected += 1
+            return False
+        else:
+            self._pending[author] = Message(**message)
+            self.delayed += 1
+
+        if not self._flusher or self._flusher.done():
+            self._flusher = asyncio.get_event_loop().create_task(self._flush())
+        return True
+
+    async def _flush(self) -> None:
+        while self._pending:
+            now = monotonic()
+            # the governor may have been disabled since these messages were held
+            if self._policy and (retry_after := self._policy.retry_after(None, now)):
+                await asyncio.sleep(retry_after)
+                continue
+            if self._policy:
+                self._policy.consume(None, now)
+            # oldest first, as dicts retain insertion order
+            author = next(iter(self._pending))
+            try:
+                await self.send(self._pending.pop(author))
+            except Exception as e:
+                log.error("Failed to send coalesced message", exc_info=e)
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+from collections import deque
+from itertools import islice
+from time import monotonic
+
+import orjson
+
+from frames import Frame
+
+__all__ = ("History",)
+
+
+class History:
+    """Bounded buffer of recently broadcast frames, for replaying to clients that reconnect
+
+    Every frame is assigned a sequence number, which is sent to API v2 clients as ``seq``;
+    clients can then reconnect with either the last sequence number or nonce they saw to have
+    anything they missed in the meantime sent to them.
+
+    Sequence numbers are local to each server worker, while nonces are the same across every
+    worker; clients that may end up reconnecting to a different worker should resume by nonce.
+    """
+
+    def __init__(self, maxlen: int = 1000, max_age: float = 300):
+        self.maxlen = maxlen
+        self.max_age = max_age
+        self.seq = 0
+        # (seq, monotonic time, nonce, frame), oldest first
+        self._entries: deque[tuple[int, float, str | None, Frame]] = deque()
+        self._by_nonce: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def seen(self, nonce: str | None) -> bool:
+        """Whether a frame with the given nonce is still stored"""
+        return nonce in self._by_nonce
+
+    def record(self, text: str, data: dict | None = None) -> Frame:
+        """Assign the next sequence number to an encoded message, and store it for replaying
+
+        ``data`` is the message before it was encoded, if it's at hand; otherwise, it's decoded
+        from ``text``, as the nonce is needed either way.
+        """
+        if data is None:
+            try:
+                data = orjson.loads(text)
+            except orjson.JSONDecodeError:
+                pass
+        if not isinstance(data, dict):
+            # not something we'd be able to attach a sequence number to
+            return Frame(text)
+
+        self.seq += 1
+        frame = Frame(text, data)
+        frame.seq = self.seq
+
+        now = monotonic()
+        nonce = data.get("nonce")
+        self._entries.append((self.seq, now, nonce, frame))
+        if isinstance(nonce, str):
+            self._by_nonce[nonce] = self.seq
+        self._expire(now)
+        return frame
+
+    def _expire(self, now: float) -> None:
+        entries = self._entries
+        while entries and (len(entries) > self.maxlen or now - entries[0][1] > self.max_age):
+            seq, _, nonce, _ = entries.popleft()
+            if nonce is not None and self._by_nonce.get(nonce) == seq:
+                del self._by_nonce[nonce]
+
+    def after(self, seq: int) -> list[Frame]:
+        """Get every frame still stored that was sent after the given sequence number
+
+        If the given sequence number is ahead of ours (i.e. the server was restarted since),
+        nothing is returned.
+        """
+        self._expire(monotonic())
+        if not self._entries or seq >= self.seq:
+            return []
+        # sequence numbers are contiguous, so this can be indexed directly
+        start = max(0, seq - self._entries[0][0] + 1)
+        return [x[3] for x in islice(self._entries, start, None)]
+
+    def after_nonce(self, nonce: str) -> list[Frame]:
+        """Get every frame still stored that was sent after the frame with the given nonce
+
+        Nothing is returned if the nonce isn't known, as there'd be no way of telling
+        what's already been seen.
+        """
+        self._expire(monotonic())
+        if (seq := self._by_nonce.get(nonce)) is None:
+            return []
+        return self.after(seq)
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import re
+from typing import Callable, Protocol
+
+__all__ = ("Mentions",)
+# user mentions are <@id> or <@!id>; channel mentions are <#id>, but have historically also been
+# matched without the #, which is kept as-is here
+MENTION = re.compile(r"<(@!?|#?)(\d+)>")
+USER_MENTION = re.compile(r"<@!?(\d+)>")
+
+
+class _Named(Protocol):
+    display_name: str
+
+
+class Mentions:
+    """Rewrites user and channel mentions in Discord messages into something readable in-game
+
+    Sanitized member display names and channel names are cached, and should be invalidated
+    whenever the corresponding member or channel is updated.
+    """
+
+    def __init__(
+        self,
+        sanitize: Callable[[str], str],
+        get_member: Callable[[int], _Named | None],
+        get_channel: Callable[[int], object | None],
+        *,
+        maxsize: int = 10_000,
+    ):
+        self.sanitize = sanitize
+        self.get_member = get_member
+        self.get_channel = get_channel
+        self.maxsize = maxsize
+        self._members: dict[int, str] = {}
+        self._channels: dict[int, str] = {}
+
+    def invalidate_member(self, member_id: int) -> None:
+        self._members.pop(member_id, None)
+
+    def invalidate_channel(self, channel_id: int) -> None:
+        self._channels.pop(channel_id, None)
+
+    def clear(self) -> None:
+        self._members.clear()
+        self._channels.clear()
+
+    @staticmethod
+    def user_ids(message: str) -> set[int]:
+        """Get the IDs of every user mentioned in a message, to look up their linked accounts"""
+        return {int(x) for x in USER_MENTION.findall(message)}
+
+    def member_name(self, member_id: int) -> str | None:
+        if (name := self._members.get(member_id)) is None:
+            if (member := self.get_member(member_id)) is None:
+                # not cached, as they may very well join later
+                return None
+            name = self.sanitize(member.display_name) or str(member)
+            if len(self._members) >= self.maxsize:
+                self._members.clear()
+            self._members[member_id] = name
+        return name
+
+    def channel_name(self, channel_id: int) -> str | None:
+        if (name := self._channels.get(channel_id)) is None:
+            if (channel := self.get_channel(channel_id)) is None:
+                return None
+            name = self.sanitize(str(channel))
+            if len(self._channels) >= self.maxsize:
+                self._channels.clear()
+            self._channels[channel_id] = name
+        return name
+
+    def rewrite(self, message: str, linked: dict[int, str] | None = None) -> str:
+        """Replace every mention in a message, in a single pass
+
+        Users with a linked Minecraft account (as given in ``linked``) are shown with their
+        in-game name instead of their display name.
+        """
+        linked = linked or {}
+
+        def replace(match: re.Match) -> str:
+            kind, id_ = match.group(1), int(match.group(2))
+            if kind.startswith("@"):
+                name = linked.get(id_) or self.member_name(id_)
+                return f"@{name}" if name is not None else "@unknown-user"
+            name = self.channel_name(id_)
+            return f"#{name}" if name is not None else "#unknown-channel"
+
+        return MENTION.sub(replace, message)
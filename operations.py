@@ -0,0 +1,156 @@
+"""
+Operations the bot can perform on the server.
+
+These are exposed both as HTTP endpoints, and as RPC calls over the bot's websocket; see
+:func:`call` for the latter.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable
+from uuid import uuid4
+
+from pydantic import BaseModel
+
+from common import ModRequest, ModResult, MuteRequest, TraceRequest, load_persistent_data
+from connections import governor, manager
+from db import User
+from tracing import tracer
+
+__all__ = ("OPERATIONS", "OperationFailed", "UnknownOperation", "call")
+
+
+class OperationFailed(Exception):
+    """Raised when an operation can't be performed, with the reason being shown to the user"""
+
+    def __init__(self, reason: str, status: int = 400):
+        super().__init__(reason)
+        self.reason = reason
+        self.status = status
+
+    def result(self) -> ModResult:
+        return {"success": False, "reason": self.reason}
+
+
+class UnknownOperation(Exception):
+    pass
+
+
+async def ban(request: ModRequest) -> ModResult:
+    target = await User.find_one({"user_id": request.id})
+    if not target:
+        target = User(user_id=request.id, key=str(uuid4()))
+        # noinspection PyArgumentList
+        await target.insert()
+    if target and target.admin:
+        raise OperationFailed("Cannot ban an admin")
+    await target.set({"banned": True, "ban_reason": request.reason})
+    # the user may very well be connected to another worker, so this has to go through
+    # the fan-out backend rather than being handled directly
+    await manager.publish(
+        {
+            "type": "ban",
+            "user": str(target.id),
+            "user_id": target.user_id,
+            "reason": target.ban_reason,
+        }
+    )
+    return {"success": True}
+
+
+async def unban(request: ModRequest) -> ModResult:
+    target = await User.find_one({"user_id": request.id})
+    if not target or not target.banned:
+        raise OperationFailed("User is not banned", status=200)
+    await target.set({"banned": False, "ban_reason": None})
+    await manager.publish({"type": "invalidate", "user_id": target.user_id})
+    return {"success": True}
+
+
+async def invalidate(request: ModRequest) -> ModResult:
+    """Drop any cached data for a user that was changed outside the server"""
+    await manager.publish({"type": "invalidate", "user_id": request.id})
+    return {"success": True}
+
+
+async def mute(request: MuteRequest) -> ModResult:
+    target = await User.find_one({"user_id": request.id})
+    if not target:
+        target = User(user_id=request.id, key=str(uuid4()))
+        # noinspection PyArgumentList
+        await target.insert()
+    if target.admin and request.until:
+        raise OperationFailed("Cannot mute an admin")
+    if target.banned:
+        raise OperationFailed("User is currently banned")
+    if not target.is_muted and not request.until:
+        raise OperationFailed("User is not currently muted")
+    await target.set({"muted_until": request.until, "mute_reason": request.reason})
+
+    await manager.publish(
+        {
+            "type": "mute",
+            "user": str(target.id),
+            "user_id": target.user_id,
+            "until": target.muted_until.isoformat() if target.muted_until else None,
+            "reason": target.mute_reason,
+        }
+    )
+    return {"success": True}
+
+
+async def reload_data() -> ModResult:
+    await load_persistent_data()
+    return {"success": True}
+
+
+async def online() -> dict[str, int]:
+    return manager.online()
+
+
+async def stats() -> dict:
+    return {
+        "connections": len(manager.active_connections),
+        "lagging": [
+            {"user": x.user, "queued": x.send_queue.qsize(), "dropped": x.dropped}
+            for x in manager.lagging()
+        ],
+        "governor": governor.stats(),
+    }
+
+
+async def trace(request: TraceRequest) -> dict:
+    if request.nonce is not None:
+        stages = tracer.get(request.nonce)
+        traces = {request.nonce: stages} if stages else {}
+    else:
+        traces = tracer.recent(request.limit)
+    return {"success": True, "sample_rate": tracer.sample_rate, "traces": traces}
+
+
+# operation name -> (handler, the model its arguments are parsed into, if it takes any)
+OPERATIONS: dict[str, tuple[Callable[..., Awaitable[Any]], type[BaseModel] | None]] = {
+    "ban": (ban, ModRequest),
+    "unban": (unban, ModRequest),
+    "invalidate": (invalidate, ModRequest),
+    "mute": (mute, MuteRequest),
+    "reload-data": (reload_data, None),
+    "online": (online, None),
+    "stats": (stats, None),
+    "trace": (trace, TraceRequest),
+}
+
+
+async def call(op: str, args: dict) -> Any:
+    """Run an operation by name, with its arguments given as a dict
+
+    Failures the user should be told about are returned like they are from the equivalent
+    HTTP endpoint, rather than raised.
+    """
+    if op not in OPERATIONS:
+        raise UnknownOperation(op)
+    handler, model = OPERATIONS[op]
+    try:
+        return await (handler(model(**args)) if model else handler())
+    except OperationFailed as e:
+        return e.result()
@@ -0,0 +1,241 @@
+"""
+Minecraft player lookups, backed by playerdb.
+
+Lookups are cached both in memory and on disk (in the SQLite database at ``PLAYER_CACHE``,
+or ``players.db`` by default; set this to an empty string to only cache in memory), so that
+players seen before a restart don't have to be looked up again afterward. Concurrent lookups
+for the same player share a single request, and entries that have expired are still returned
+immediately while they're refreshed in the background.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Awaitable, Callable
+
+import aiohttp
+
+if TYPE_CHECKING:
+    from common import PlayerData
+
+__all__ = ("PlayerDB", "PlayerLookup", "PlayerStore", "players")
+log = logging.getLogger("players")
+
+# given a username or uuid, returns either the player's data or None if they don't exist; any
+# other failure should be raised instead, so that it isn't cached as a nonexistent player
+Fetcher = Callable[[str], Awaitable["PlayerData | None"]]
+
+
+class PlayerDB:
+    """Fetches players from playerdb, or anything else serving the same API at ``base_url``"""
+
+    def __init__(self, base_url: str = "https://playerdb.co/api/player/minecraft/"):
+        self.base_url = base_url
+        self._session: aiohttp.ClientSession | None = None
+
+    async def __call__(self, username_or_uuid: str) -> PlayerData | None:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        async with self._session.get(self.base_url + username_or_uuid) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+            elif resp.status == 400 and await self._not_found(resp):
+                return None
+            else:
+                # anything else (e.g. being rate limited) isn't an answer, and so mustn't be
+                # cached as one
+                raise aiohttp.ClientResponseError(
+                    resp.request_info,
+                    resp.history,
+                    status=resp.status,
+                    message=resp.reason or "",
+                    headers=resp.headers,
+                )
+        if not data or not data.get("success") or "data" not in data:
+            return None
+        return data["data"]["player"]
+
+    @staticmethod
+    async def _not_found(resp: aiohttp.ClientResponse) -> bool:
+        """Whether a 400 response is playerdb saying the player doesn't exist"""
+        try:
+            data = await resp.json(content_type=None)
+        except ValueError:
+            return False
+        # e.g. minecraft.invalid_username, as opposed to minecraft.api_failure
+        return (
+            isinstance(data, dict)
+            and data.get("success") is False
+            and str(data.get("code", "")).startswith("minecraft.invalid_")
+        )
+
+    async def close(self) -> None:
+        if self._session:
+            await self._session.close()
+
+
+class PlayerStore:
+    """On-disk copy of every lookup, which is only ever read from once per player"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db: sqlite3.Connection | None = None
+        # sqlite connections can't be used concurrently, and calls are made from a thread pool
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS players"
+                " (key TEXT PRIMARY KEY, data TEXT, fetched REAL NOT NULL)"
+            )
+        return self._db
+
+    def _get(self, key: str) -> tuple[PlayerData | None, float] | None:
+        with self._lock:
+            row = (
+                self._connect()
+                .execute("SELECT data, fetched FROM players WHERE key = ?", (key,))
+                .fetchone()
+            )
+        if row is None:
+            return None
+        return (json.loads(row[0]) if row[0] is not None else None), row[1]
+
+    def _put(self, keys: list[str], data: PlayerData | None, fetched: float) -> None:
+        encoded = json.dumps(data) if data is not None else None
+        with self._lock, self._connect() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO players (key, data, fetched) VALUES (?, ?, ?)",
+                [(key, encoded, fetched) for key in keys],
+            )
+
+    async def get(self, key: str) -> tuple[PlayerData | None, float] | None:
+        return await asyncio.to_thread(self._get, key)
+
+    async def put(self, keys: list[str], data: PlayerData | None, fetched: float) -> None:
+        await asyncio.to_thread(self._put, keys, data, fetched)
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class PlayerLookup:
+    def __init__(
+        self,
+        fetcher: Fetcher | None = None,
+        store: PlayerStore | None = None,
+        *,
+        maxsize: int = 2048,
+        ttl: float = 6 * 60 * 60,
+        negative_ttl: float = 10 * 60,
+    ):
+        self.fetcher = fetcher or PlayerDB()
+        self.store = store
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # players that don't exist are only cached for a short while, as they may simply be
+        # in the middle of changing their username
+        self.negative_ttl = negative_ttl
+        # (player data, wall clock time it was fetched at), least recently used first
+        self._cache: OrderedDict[str, tuple[PlayerData | None, float]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    @classmethod
+    def from_env(cls) -> PlayerLookup:
+        path = os.getenv("PLAYER_CACHE", "players.db")
+        base_url = os.getenv("PLAYERDB_URL")
+        return cls(
+            fetcher=PlayerDB(base_url) if base_url else None,
+            store=PlayerStore(path) if path else None,
+        )
+
+    def _fresh(self, entry: tuple[PlayerData | None, float]) -> bool:
+        ttl = self.ttl if entry[0] is not None else self.negative_ttl
+        return time.time() - entry[1] < ttl
+
+    def _remember(self, key: str, entry: tuple[PlayerData | None, float]) -> None:
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    async def get(self, username_or_uuid: str, *, timeout: float = 10) -> PlayerData | None:
+        """Look up a player by either their username or uuid
+
+        ``None`` is returned if the player doesn't exist, or if they couldn't be looked up
+        within ``timeout`` seconds and nothing was previously cached for them.
+        """
+        key = username_or_uuid.casefold()
+        entry = self._cache.get(key)
+        if entry is None and self.store is not None:
+            try:
+                entry = await self.store.get(key)
+            except sqlite3.Error as e:
+                log.warning("Failed to read cached player %s", key, exc_info=e)
+            if entry is not None:
+                self._remember(key, entry)
+
+        if entry is not None:
+            self._cache.move_to_end(key)
+            if self._fresh(entry):
+                return entry[0]
+            if entry[0] is not None:
+                # serve whatever we had, and let the refresh happen in the background
+                self._refresh(key)
+                return entry[0]
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._refresh(key)), timeout)
+        except asyncio.TimeoutError:
+            log.warning("Timed out looking up player %s", key)
+            return None
+
+    def _refresh(self, key: str) -> asyncio.Task:
+        if (task := self._inflight.get(key)) is None:
+            task = self._inflight[key] = asyncio.get_event_loop().create_task(self._fetch(key))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return task
+
+    async def _fetch(self, key: str) -> PlayerData | None:
+        try:
+            data = await self.fetcher(key)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning("Failed to look up player %s", key, exc_info=e)
+            # failures aren't cached, but anything we already had is better than nothing
+            entry = self._cache.get(key)
+            return entry[0] if entry else None
+
+        entry = (data, time.time())
+        keys = [key]
+        if data is not None:
+            keys.extend(x.casefold() for x in (data["username"], data["id"]) if x.casefold() != key)
+        for x in keys:
+            self._remember(x, entry)
+        if self.store is not None:
+            try:
+                await self.store.put(keys, *entry)
+            except sqlite3.Error as e:
+                log.warning("Failed to cache player %s", key, exc_info=e)
+        return data
+
+    async def close(self) -> None:
+        for task in self._inflight.values():
+            task.cancel()
+        if isinstance(self.fetcher, PlayerDB):
+            await self.fetcher.close()
+        if self.store is not None:
+            self.store.close()
+
+
+players = PlayerLookup.from_env()
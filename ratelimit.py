@@ -0,0 +1,216 @@
+"""
+Rate limiting engine used for chat messages on both the server and the bot.
+
+Limits are grouped by scope; the server checks messages against the ``global``, ``user``
+(per user document) and ``connection`` scopes, while the bot checks messages against the
+``author`` scope (per Discord user). Each scope can have any number of policies, which can be
+configured with the ``rate_limits`` key in the persistent data file:
+
+.. code-block:: json
+
+    {
+        "rate_limits": {
+            "user": [{"type": "gcra", "limit": 5, "period": 4}, {"limit": 40, "period": 60}],
+            "global": [{"type": "token_bucket", "limit": 20, "period": 1, "burst": 40}]
+        }
+    }
+
+If no limits are configured, ``SPAM_INTERVALS`` is used for the ``user`` and ``author`` scopes.
+"""
+
+from __future__ import annotations
+
+import logging
+from datetime import timedelta
+from time import monotonic
+from typing import Hashable
+
+from antispam import AntiSpam
+from common import SPAM_INTERVALS, get_persistent_data
+
+__all__ = ("GCRA", "Policy", "RateLimiter", "SlidingWindow", "TokenBucket", "limiter")
+log = logging.getLogger("ratelimit")
+
+DEFAULT_POLICIES = {
+    scope: [
+        {"type": "gcra", "limit": limit, "period": period.total_seconds()}
+        for period, limit in SPAM_INTERVALS
+    ]
+    for scope in ("user", "author")
+}
+_UNSET = object()
+
+
+class Policy:
+    """A rate limit tracked separately for every key it's checked against
+
+    ``limit`` events are allowed per ``period`` seconds, of which up to ``burst`` events
+    (defaulting to ``limit``) may happen all at once.
+    """
+
+    def __init__(self, limit: int, period: float, burst: int | None = None):
+        self.limit = limit
+        self.period = period
+        self.burst = burst or limit
+        self._state: dict[Hashable, object] = {}
+        self._prune_at = 1024
+
+    @classmethod
+    def from_config(cls, config: dict) -> Policy:
+        return cls(limit=config["limit"], period=config["period"], burst=config.get("burst"))
+
+    def retry_after(self, key: Hashable, now: float) -> float:
+        """How long until the given key is allowed another event, or 0 if it currently is"""
+        raise NotImplementedError
+
+    def consume(self, key: Hashable, now: float) -> None:
+        """Record an event for the given key"""
+        raise NotImplementedError
+
+    def forget(self, key: Hashable) -> None:
+        """Drop everything recorded for the given key"""
+        self._state.pop(key, None)
+
+    def _idle(self, state, now: float) -> bool:
+        """Whether the given state is equivalent to never having seen the key at all"""
+        raise NotImplementedError
+
+    def _maybe_prune(self, now: float) -> None:
+        if len(self._state) < self._prune_at:
+            return
+        self._state = {k: v for k, v in self._state.items() if not self._idle(v, now)}
+        self._prune_at = max(1024, len(self._state) * 2)
+
+
+class GCRA(Policy):
+    """Generic cell rate algorithm; only a single timestamp is stored per key"""
+
+    def __init__(self, limit: int, period: float, burst: int | None = None):
+        super().__init__(limit, period, burst)
+        self.emission = period / limit
+        self.tolerance = self.emission * (self.burst - 1)
+
+    def retry_after(self, key: Hashable, now: float) -> float:
+        # the theoretical arrival time of the next event
+        tat = self._state.get(key, now)
+        return max(0.0, tat - self.tolerance - now)
+
+    def consume(self, key: Hashable, now: float) -> None:
+        self._state[key] = max(self._state.get(key, now), now) + self.emission
+        self._maybe_prune(now)
+
+    def _idle(self, state: float, now: float) -> bool:
+        return state <= now
+
+
+class TokenBucket(Policy):
+    """Classic token bucket, holding ``burst`` tokens and refilling ``limit`` per ``period``"""
+
+    def __init__(self, limit: int, period: float, burst: int | None = None):
+        super().__init__(limit, period, burst)
+        self.refill = limit / period
+
+    def _tokens(self, key: Hashable, now: float) -> float:
+        if (state := self._state.get(key)) is None:
+            return self.burst
+        tokens, updated = state
+        return min(self.burst, tokens + (now - updated) * self.refill)
+
+    def retry_after(self, key: Hashable, now: float) -> float:
+        return max(0.0, (1 - self._tokens(key, now)) / self.refill)
+
+    def consume(self, key: Hashable, now: float) -> None:
+        self._state[key] = (self._tokens(key, now) - 1, now)
+        self._maybe_prune(now)
+
+    def _idle(self, state: tuple[float, float], now: float) -> bool:
+        return state[0] + (now - state[1]) * self.refill >= self.burst
+
+
+class SlidingWindow(Policy):
+    """Exact sliding window, using the same logic as :class:`AntiSpam`"""
+
+    def _limiter(self, key: Hashable) -> AntiSpam:
+        if (state := self._state.get(key)) is None:
+            return AntiSpam([(timedelta(seconds=self.period), self.limit)])
+        return state[0]
+
+    def retry_after(self, key: Hashable, now: float) -> float:
+        limiter = self._limiter(key)
+        if not limiter.spammy:
+            return 0.0
+        return limiter.time_left()[1].total_seconds()
+
+    def consume(self, key: Hashable, now: float) -> None:
+        limiter = self._limiter(key)
+        limiter.stamp()
+        self._state[key] = (limiter, now)
+        self._maybe_prune(now)
+
+    def _idle(self, state: tuple[AntiSpam, float], now: float) -> bool:
+        return now - state[1] > self.period
+
+
+POLICIES: dict[str, type[Policy]] = {
+    "gcra": GCRA,
+    "token_bucket": TokenBucket,
+    "window": SlidingWindow,
+}
+
+
+class RateLimiter:
+    """Checks events against every policy configured for the given scopes"""
+
+    def __init__(self):
+        self._config = _UNSET
+        self._policies: dict[str, list[Policy]] = {}
+
+    def _refresh(self) -> None:
+        # the persistent data dict is replaced outright whenever it's reloaded, so checking
+        # identity is enough to pick up on configuration changes
+        config = get_persistent_data().get("rate_limits")
+        if config is self._config:
+            return
+
+        self._config = config
+        try:
+            self._policies = {
+                scope: [POLICIES[x.get("type", "gcra")].from_config(x) for x in policies]
+                for scope, policies in (config or DEFAULT_POLICIES).items()
+            }
+        except (KeyError, TypeError, ValueError, ZeroDivisionError) as e:
+            log.error("Invalid rate limit configuration, using the defaults instead", exc_info=e)
+            self._policies = {
+                scope: [GCRA.from_config(x) for x in policies]
+                for scope, policies in DEFAULT_POLICIES.items()
+            }
+
+    def hit(self, *keys: tuple[str, Hashable]) -> float:
+        """Check an event against the given ``(scope, key)`` pairs
+
+        If the event is allowed, it's recorded against every policy and ``0.0`` is returned;
+        otherwise, nothing is recorded, and the number of seconds until the event would be
+        allowed is returned instead.
+        """
+        self._refresh()
+        now = monotonic()
+        retry_after = 0.0
+        checked: list[tuple[Policy, Hashable]] = []
+        for scope, key in keys:
+            for policy in self._policies.get(scope, ()):
+                retry_after = max(retry_after, policy.retry_after(key, now))
+                checked.append((policy, key))
+
+        if retry_after > 0:
+            return retry_after
+        for policy, key in checked:
+            policy.consume(key, now)
+        return 0.0
+
+    def forget(self, scope: str, key: Hashable) -> None:
+        """Drop everything recorded for a key that won't be seen again, e.g. a closed connection"""
+        for policy in self._policies.get(scope, ()):
+            policy.forget(key)
+
+
+limiter = RateLimiter()
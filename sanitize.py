@@ -0,0 +1,148 @@
+"""
+Text sanitization for messages passing between Discord and the game.
+
+Each direction is handled by a single ``str.translate`` call. The translation tables decide
+what to do with each character the first time they see it, and remember that decision for
+every later message.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import re
+import unicodedata
+from pathlib import Path
+from time import monotonic
+
+__all__ = ("EMOJI", "FORMAT_CODE", "Sanitizer", "is_possibly_soopy", "sanitizer")
+log = logging.getLogger("sanitize")
+
+ALLOWED_UNICODE_FILE = Path(__file__).parent / "allowed_unicode.txt"
+# smart quotes were a mistake
+# https://stackoverflow.com/a/41516221
+SMART_QUOTES = {ord(x): ord(y) for x, y in zip("‘’´“”–", "'''\"\"-")}
+# text direction overrides, which can be used to make messages render misleadingly
+BIDI_CONTROLS = {*range(0x202A, 0x202F), *range(0x2066, 0x206A)}
+# an upper bound on how many characters are remembered, so that messages made up of
+# every character under the sun can't grow the tables indefinitely
+MAX_CACHED = 65536
+# custom emoji, which are replaced with just their :name: before being sent to the game
+EMOJI = re.compile(r"<a?(:[^:]+:)\d+>")
+# formatting codes, which are stripped from messages before being posted to discord
+FORMAT_CODE = re.compile(r"§[0-9A-FK-ORZ]", re.IGNORECASE)
+
+
+class _Table(dict):
+    """Translation table which works out what to do with each character on first sight"""
+
+    __slots__ = ("_decide",)
+
+    def __init__(self, fixed: dict[int, int | None], decide):
+        super().__init__(fixed)
+        self._decide = decide
+
+    def __missing__(self, codepoint: int) -> int | None:
+        value = self._decide(codepoint)
+        if len(self) < MAX_CACHED:
+            self[codepoint] = value
+        return value
+
+
+def _game_decision(codepoint: int) -> int | None:
+    if unicodedata.category(chr(codepoint)) == "Cc" or codepoint in BIDI_CONTROLS:
+        return None
+    return codepoint
+
+
+class Sanitizer:
+    """Holds the translation tables used for each direction
+
+    ``allowed_unicode.txt`` is watched for changes, and is reloaded by :meth:`maybe_reload`
+    when it's changed.
+    """
+
+    def __init__(self, path: Path = ALLOWED_UNICODE_FILE, *, check_interval: float = 5):
+        self.path = path
+        self.check_interval = check_interval
+        self.allowed: frozenset[str] = frozenset()
+        self._mtime: float | None = None
+        self._checked = 0.0
+        self._to_game = self._build_to_game()
+        self._from_game = _Table(
+            # newlines are folded into spaces rather than being stripped outright
+            {ord("\n"): ord(" "), ord("\r"): None},
+            _game_decision,
+        )
+
+    def _build_to_game(self) -> _Table:
+        allowed = self.allowed
+
+        # 1.8.9 is an absolutely ancient version and has no concept of a significant amount
+        # of unicode characters that exist, so just strip out characters it doesn't recognize
+        def decide(codepoint: int) -> int | None:
+            if 32 <= codepoint < 127 or chr(codepoint) in allowed:
+                return codepoint
+            return None
+
+        return _Table(
+            {**SMART_QUOTES, ord("\n"): ord(" "), ord("\t"): ord(" "), ord("\r"): None}, decide
+        )
+
+    def load(self) -> None:
+        allowed = set()
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line.startswith("#") or not line:
+                    continue
+                allowed.update(line)
+        self._mtime = os.stat(self.path).st_mtime
+        self.allowed = frozenset(allowed)
+        # swapped out all at once, so that nothing ever sees a partially built table
+        self._to_game = self._build_to_game()
+        log.info(f"Loaded {len(self.allowed)} allowed unicode characters")
+
+    def maybe_reload(self) -> bool:
+        """Reload the allowed characters if their file has changed since it was last loaded,
+        checking at most once every ``check_interval`` seconds
+
+        Returns whether anything was reloaded.
+        """
+        now = monotonic()
+        if now - self._checked < self.check_interval:
+            return False
+        self._checked = now
+        try:
+            if os.stat(self.path).st_mtime == self._mtime:
+                return False
+            self.load()
+        except OSError as e:
+            log.warning("Failed to reload allowed unicode characters", exc_info=e)
+            return False
+        return True
+
+    def to_game(self, text: str) -> str:
+        """Sanitize text from Discord to be displayed in-game"""
+        return text.translate(self._to_game)
+
+    def from_game(self, text: str) -> str:
+        """Sanitize text sent from the game"""
+        return text.translate(self._from_game)
+
+
+def is_possibly_soopy(message: str) -> bool:
+    """Whether a message looks like a Soopy command, i.e. starts with a dash"""
+    if not message.startswith("-") or message.startswith("- "):
+        return False
+
+    try:
+        # ignore messages which are simply negative numbers
+        float(message[1:].split(" ")[0])
+    except ValueError:
+        return True
+    else:
+        return False
+
+
+sanitizer = Sanitizer()
@@ -1,16 +1,26 @@
+import asyncio
+import logging
 import os
 from contextlib import asynccontextmanager
-from datetime import datetime
 from typing import Annotated
-from uuid import uuid4
 
+import orjson
 from dotenv import load_dotenv
 from fastapi import FastAPI, Header, WebSocket, WebSocketDisconnect, WebSocketException, status
-from fastapi.responses import JSONResponse
-
-from common import ModRequest, MuteRequest, delta_to_str, load_persistent_data
+from fastapi.responses import JSONResponse, PlainTextResponse
+from pydantic import BaseModel, ValidationError
+
+import fanout
+import operations
+from auth import key_cache
+from capture import capture
+from common import ModRequest, MuteRequest, RPCRequest, RPCResult, TraceRequest
 from connections import UserConnection, manager
 from db import User, init
+from frames import Frame, decode
+from metrics import registry
+from store import store
+from tracing import tracer
 
 
 @asynccontextmanager
@@ -18,148 +28,199 @@ async def before_startup(_):
     load_dotenv()
     os.environ.pop("DISCORD_TOKEN")
     await init()
+    await store.load()
+    # the bot writes to this file as well, so keep an eye out for anything it changes
+    store.watch()
+    key_cache.load_config()
+    tracer.load_config()
+    capture.load_config()
+    capture.start()
+    await manager.start(fanout.from_env())
     yield
+    await manager.stop()
+    await capture.stop()
+    store.stop()
 
 
 app = FastAPI(lifespan=before_startup)
-
-
-def uuid():
-    return str(uuid4())
+log = logging.getLogger("server")
+# rpc calls currently running, so that they don't get garbage collected mid-call
+_rpc_tasks: set[asyncio.Task] = set()
 
 
 async def get_user_from_key(key: str) -> User | None:
-    return await User.find_one({"key": key})
+    return await key_cache.get(key)
 
 
 def is_valid_bot_key(key: str) -> bool:
     return key is not None and key == os.environ["BOT_KEY"]
 
 
+def _invalid_bot_key() -> JSONResponse:
+    return JSONResponse(status_code=403, content={"success": False, "reason": "Invalid bot key"})
+
+
+async def _run(op: str, request: BaseModel | None = None):
+    handler, _ = operations.OPERATIONS[op]
+    try:
+        return await (handler(request) if request else handler())
+    except operations.OperationFailed as e:
+        return JSONResponse(status_code=e.status, content=e.result())
+
+
 @app.post("/reload-data")
-def reload_data(bot_key: Annotated[str, Header()]):
+async def reload_data(bot_key: Annotated[str, Header()]):
     if not is_valid_bot_key(bot_key):
-        return JSONResponse(
-            status_code=403, content={"success": False, "reason": "Invalid bot key"}
-        )
-
-    load_persistent_data()
-    return {"success": True}
+        return _invalid_bot_key()
+    return await _run("reload-data")
 
 
 @app.post("/ban")
 async def ban(request: ModRequest, bot_key: Annotated[str, Header()]):
     if not is_valid_bot_key(bot_key):
-        return JSONResponse(
-            status_code=403, content={"success": False, "reason": "Invalid bot key"}
-        )
-
-    target = await User.find_one({"user_id": request.id})
-    if not target:
-        target = User(user_id=request.id, key=uuid())
-        # noinspection PyArgumentList
-        await target.insert()
-    if target and target.admin:
-        return JSONResponse(
-            status_code=400,
-            content={"success": False, "reason": "Cannot ban an admin"},
-        )
-    await target.set({"banned": True, "ban_reason": request.reason})
-
-    for connection in manager.all_from(target):
-        await connection.send_system(
-            f"§cYou have been banned:§r {target.ban_reason or 'No reason specified'}"
-        )
-        await connection.disconnect(reason="You have been banned", code=1008)
-
-    return {"success": True}
+        return _invalid_bot_key()
+    return await _run("ban", request)
 
 
 @app.post("/unban")
 async def unban(request: ModRequest, bot_key: Annotated[str, Header()]):
     if not is_valid_bot_key(bot_key):
-        return JSONResponse(
-            status_code=403, content={"success": False, "reason": "Invalid bot key"}
-        )
+        return _invalid_bot_key()
+    return await _run("unban", request)
 
-    target = await User.find_one({"user_id": request.id})
-    if not target or not target.banned:
-        return {"success": False, "reason": "User is not banned"}
-    await target.set({"banned": False, "ban_reason": None})
-    return {"success": True}
+
+@app.post("/invalidate")
+async def invalidate(request: ModRequest, bot_key: Annotated[str, Header()]):
+    """Drop any cached data for a user that was changed outside the server"""
+    if not is_valid_bot_key(bot_key):
+        return _invalid_bot_key()
+    return await _run("invalidate", request)
 
 
 @app.post("/mute")
 async def mute(request: MuteRequest, bot_key: Annotated[str, Header()]):
     if not is_valid_bot_key(bot_key):
-        return JSONResponse(
-            status_code=403, content={"success": False, "reason": "Invalid bot key"}
-        )
+        return _invalid_bot_key()
+    return await _run("mute", request)
 
-    target = await User.find_one({"user_id": request.id})
-    if not target:
-        target = User(user_id=request.id, key=uuid())
-        # noinspection PyArgumentList
-        await target.insert()
-    if target.admin and request.until:
-        return JSONResponse(
-            status_code=400,
-            content={"success": False, "reason": "Cannot mute an admin"},
-        )
-    if target.banned:
-        return JSONResponse(
-            status_code=400,
-            content={"success": False, "reason": "User is currently banned"},
-        )
-    if not target.is_muted and not request.until:
-        return JSONResponse(
-            status_code=400,
-            content={"success": False, "reason": "User is not currently muted"},
-        )
-    await target.set({"muted_until": request.until, "mute_reason": request.reason})
 
-    for connection in manager.all_from(target):
-        connection.user_data = target
-        if target.is_muted:
-            duration = delta_to_str(connection.user_data.muted_until - datetime.utcnow())
-            reason = connection.user_data.mute_reason or "No reason specified"
-            await connection.send_system(f"§cYou have been muted for {duration}:§r {reason}")
-        else:
-            await connection.send_system("§bYou have been unmuted.")
+@app.get("/online")
+async def online(bot_key: Annotated[str, Header()]):
+    if not is_valid_bot_key(bot_key):
+        return _invalid_bot_key()
+    return await _run("online")
+
 
-    return {"success": True}
+@app.get("/stats")
+async def stats(bot_key: Annotated[str, Header()]):
+    if not is_valid_bot_key(bot_key):
+        return _invalid_bot_key()
+    return await _run("stats")
 
 
-@app.get("/online")
-async def online(bot_key: Annotated[str, Header()]):
+@app.post("/trace")
+async def trace(request: TraceRequest, bot_key: Annotated[str, Header()]):
     if not is_valid_bot_key(bot_key):
-        return JSONResponse(
-            status_code=403, content={"success": False, "reason": "Invalid bot key"}
-        )
+        return _invalid_bot_key()
+    return await _run("trace", request)
+
 
-    return {x.user: x.user_data.user_id for x in manager.active_connections if not x.system}
+@app.get("/metrics")
+async def metrics(bot_key: Annotated[str, Header()]):
+    # note that these are only for whichever worker happens to handle the request
+    if not is_valid_bot_key(bot_key):
+        return _invalid_bot_key()
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+async def _handle_rpc(connection: UserConnection, request: RPCRequest) -> None:
+    reply: RPCResult = {"type": "rpc_result", "id": request.get("id"), "ok": True}
+    # a request without an op is just an unknown operation, rather than a KeyError to be logged
+    op = request.get("op")
+    try:
+        reply["result"] = await operations.call(op, request.get("args") or {})
+    except operations.UnknownOperation:
+        reply.update(ok=False, reason=f"Unknown operation {op!r}")
+    except ValidationError as e:
+        reply.update(ok=False, reason=f"Invalid arguments: {e}")
+    except Exception as e:
+        log.error(f"Failed to run {op!r} over RPC", exc_info=e)
+        reply.update(ok=False, reason="An unexpected error occurred")
+    connection.enqueue(Frame.from_data(reply))
+
+
+def _already_delivered(connection: UserConnection, message: dict) -> bool:
+    nonce = message.get("nonce")
+    if not manager.history.seen(nonce):
+        return False
+    # the bot would otherwise be waiting on an echo that'll never come
+    connection.enqueue(Frame.from_data({"type": "ack", "nonce": nonce}))
+    return True
 
 
 @app.websocket("/bot/{bot_key}")
-async def bot_websocket(ws: WebSocket, bot_key: str):
+async def bot_websocket(ws: WebSocket, bot_key: str, resume_nonce: str | None = None):
     if not is_valid_bot_key(bot_key):
         raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
 
     connection = UserConnection("", ws, system=True)
-    await manager.connect(connection)
+    # the bot resumes by nonce rather than sequence number, as it may reconnect to a different
+    # worker than it was previously connected to
+    await manager.connect(connection, resume_nonce=resume_nonce)
+    captured = capture.connected("", bot_key)
     try:
         while True:
-            message = await ws.receive_json()
-            await manager.broadcast(message)
+            text = await ws.receive_text()
+            # the bot may batch several messages into a single array, and resends anything that
+            # wasn't echoed back to it before reconnecting, which may have already been delivered
+            try:
+                data = orjson.loads(text)
+            except orjson.JSONDecodeError:
+                log.warning("Ignoring malformed frame from the bot")
+                continue
+            if isinstance(data, dict) and data.get("type") == "rpc":
+                # these are run separately, so that a slow operation doesn't hold up messages
+                task = asyncio.get_event_loop().create_task(_handle_rpc(connection, data))
+                _rpc_tasks.add(task)
+                task.add_done_callback(_rpc_tasks.discard)
+                continue
+            capture.frame(captured, data)
+            messages = [
+                x for x in (data if isinstance(data, list) else (data,)) if isinstance(x, dict)
+            ]
+            if len(messages) != (len(data) if isinstance(data, list) else 1):
+                log.warning("Ignoring anything from the bot that isn't a JSON object")
+            for message in messages:
+                tracer.mark(message.get("nonce"), "receive")
+            if isinstance(data, dict):
+                # single messages are already fully formed, so there's no point in re-encoding them
+                if not _already_delivered(connection, data):
+                    await manager.broadcast_frame(text, data)
+                continue
+            for message in messages:
+                if not _already_delivered(connection, message):
+                    await manager.broadcast(message)
     except WebSocketDisconnect:
-        manager.disconnect(connection)
+        pass
+    finally:
+        # this has to happen however the connection ended, or it'd keep being broadcast to
+        capture.disconnected(captured)
+        await manager.disconnect(connection)
 
 
 @app.websocket("/ws/{username}/{key}")
 async def websocket(
-    ws: WebSocket, username: str, key: str, api_version: Annotated[int, Header()] = 0
+    ws: WebSocket,
+    username: str,
+    key: str,
+    api_version: Annotated[int, Header()] = 0,
+    api_encoding: Annotated[str, Header()] = "json",
+    resume_after: Annotated[int | None, Header()] = None,
+    resume_nonce: Annotated[str | None, Header()] = None,
 ):
-    if api_version not in (0, 1):
+    # v2 clients may additionally request permessage-deflate compression as part of the
+    # handshake, which is negotiated by uvicorn itself.
+    if api_version not in (0, 1, 2) or api_encoding not in ("json", "msgpack"):
         raise WebSocketException(code=status.WS_1003_UNSUPPORTED_DATA)
 
     user = await get_user_from_key(key)
@@ -171,8 +232,11 @@ async def websocket(
             code=status.WS_1008_POLICY_VIOLATION, reason=f"You are banned: {ban_reason}"
         )
 
-    connection = UserConnection(username, ws, user_data=user)
-    await manager.connect(connection)
+    connection = UserConnection(
+        username, ws, user_data=user, api_version=api_version, encoding=api_encoding
+    )
+    await manager.connect(connection, resume_after=resume_after, resume_nonce=resume_nonce)
+    captured = capture.connected(username, key, api_version=api_version, encoding=api_encoding)
 
     if api_version == 0 and not os.getenv("DEBUG"):
         await connection.send_system(
@@ -187,11 +251,33 @@ async def websocket(
         while True:
             if api_version == 0:
                 message = await ws.receive_text()
+                capture.frame(captured, message)
                 await connection.handle_ws_request("send", {"data": message})
             elif api_version == 1:
                 data = await ws.receive_json()
+                capture.frame(captured, data)
                 if "type" not in data:
                     continue
                 await connection.handle_ws_request(data["type"], data)
+            elif api_version == 2:
+                message = await ws.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                try:
+                    batch = decode(message.get("text"), message.get("bytes"))
+                except ValueError:
+                    # both orjson and msgpack raise subclasses of this for anything malformed
+                    await connection.disconnect(
+                        code=status.WS_1007_INVALID_FRAME_PAYLOAD_DATA, reason="Malformed frame"
+                    )
+                    break
+                capture.frame(captured, batch)
+                for data in batch:
+                    if "type" in data:
+                        await connection.handle_ws_request(data["type"], data)
     except WebSocketDisconnect:
-        manager.disconnect(connection)
+        pass
+    finally:
+        # this has to happen however the connection ended, or it'd keep being broadcast to
+        capture.disconnected(captured)
+        await manager.disconnect(connection)
@@ -0,0 +1,93 @@
+"""
+Persistent data shared between the bot and the server, stored as JSON in ``data.json``.
+
+Reads are served entirely from memory. Writes go to a temporary file that then replaces the
+data file, so a crash mid-write can never leave it corrupted, and all file I/O happens off of
+the event loop. Each process polls the file for changes made by any other process (or by hand),
+and reloads it when it changes; the loaded dict is replaced outright whenever this happens,
+which allows for anything derived from it to cheaply check for changes by identity.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+
+__all__ = ("PersistentStore", "store")
+log = logging.getLogger("store")
+
+
+class PersistentStore:
+    def __init__(self, path: str | Path = "data.json", *, poll_interval: float = 0.5):
+        self.path = Path(path)
+        self.poll_interval = poll_interval
+        self.data: dict = {}
+        self._stat: tuple[int, int] | None = None
+        self._lock = asyncio.Lock()
+        self._watcher: asyncio.Task | None = None
+
+    def _current_stat(self) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read(self) -> tuple[dict, tuple[int, int] | None]:
+        # the stat is taken first, so that a write racing with this read is picked up by the
+        # watcher next time around instead of being missed
+        stat = self._current_stat()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f), stat
+        except FileNotFoundError:
+            log.warning(f"{self.path} doesn't exist, starting with empty persistent data")
+            return {}, stat
+
+    def _write(self, encoded: str) -> tuple[int, int] | None:
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp, mode="w", encoding="utf-8") as f:
+            f.write(encoded)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        return self._current_stat()
+
+    async def load(self) -> None:
+        async with self._lock:
+            data, self._stat = await asyncio.to_thread(self._read)
+            self.data = data
+
+    async def save(self) -> None:
+        async with self._lock:
+            # encoded here rather than in the thread, as the data may be modified in the meantime
+            encoded = json.dumps(self.data)
+            self._stat = await asyncio.to_thread(self._write, encoded)
+
+    def watch(self) -> None:
+        """Start reloading the data whenever its file is changed"""
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.get_event_loop().create_task(self._watch())
+
+    def stop(self) -> None:
+        if self._watcher:
+            self._watcher.cancel()
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if self._lock.locked() or self._current_stat() == self._stat:
+                continue
+            log.info(f"{self.path} was changed, reloading")
+            try:
+                await self.load()
+            except (OSError, ValueError) as e:
+                # most likely someone's in the middle of editing it by hand
+                log.error(f"Failed to reload {self.path}", exc_info=e)
+                self._stat = self._current_stat()
+
+
+store = PersistentStore()
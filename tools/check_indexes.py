@@ -0,0 +1,84 @@
+"""
+Checks that user lookups are served by indexes rather than collection scans.
+
+Connects to the database at ``MONGO_HOST`` (defaulting to a local mongod), and reports:
+
+- any duplicate keys or user ids, which would prevent the unique indexes from being created
+- the query plan and number of documents examined for each lookup the bridge makes
+
+Run with ``python -m tools.check_indexes`` from the repository root; exits with a non-zero
+status if any lookup isn't an index hit.
+"""
+
+import argparse
+import os
+import sys
+
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+# the same queries made by the server and the bot
+LOOKUPS = {
+    "key (websocket connect)": lambda user: {"key": user["key"]},
+    "user_id (discord message)": lambda user: {"user_id": user["user_id"]},
+    "user_id $in (mentions)": lambda user: {"user_id": {"$in": [user["user_id"], -1]}},
+}
+
+
+def _stages(plan: dict) -> list[str]:
+    stages = [plan["stage"]]
+    if "inputStage" in plan:
+        stages.extend(_stages(plan["inputStage"]))
+    for child in plan.get("inputStages", ()):
+        stages.extend(_stages(child))
+    return stages
+
+
+def _duplicates(collection, field: str) -> list:
+    return [
+        x["_id"]
+        for x in collection.aggregate(
+            [
+                {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+                {"$match": {"count": {"$gt": 1}}},
+            ]
+        )
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database", default="swsh-bridge")
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = MongoClient(os.environ.get("MONGO_HOST", "mongodb://localhost:27017"))
+    collection = client[args.database]["User"]
+
+    for field in ("key", "user_id"):
+        if duplicates := _duplicates(collection, field):
+            print(f"Duplicate {field} values, which must be resolved first: {duplicates}")
+
+    print("Indexes:", ", ".join(sorted(collection.index_information())))
+    sample = collection.find_one({}, {"key": 1, "user_id": 1})
+    if sample is None:
+        # explaining against an empty collection still shows which plan would be used
+        sample = {"key": "", "user_id": 0}
+
+    ok = True
+    for name, query in LOOKUPS.items():
+        explain = collection.find(query(sample)).explain()
+        stages = _stages(explain["queryPlanner"]["winningPlan"])
+        examined = explain.get("executionStats", {}).get("totalDocsExamined", "?")
+        hit = "IXSCAN" in stages or "IDHACK" in stages or "EXPRESS_IXSCAN" in stages
+        ok &= hit
+        print(
+            f"{'ok' if hit else 'COLLSCAN':>8} | {name:<26} | {' <- '.join(stages)}"
+            f" | {examined} docs examined"
+        )
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""
+Load tests the bridge server with simulated mod clients and a simulated bot.
+
+Starts a server on a free local port, with users served from memory instead of from Mongo, and
+connects ``--clients`` mod clients (split between API versions 0 and 1) and a bot to it. These
+then send chat messages at a combined ``--rate`` messages per second for ``--duration`` seconds,
+after which the following are reported:
+
+- broadcast latency percentiles, from a message being sent to each observing client receiving it
+- server CPU time per message sent, and per frame received by a client
+- server memory per connection
+- connections that were dropped by the server, or that stopped receiving messages partway through
+
+Run with ``python -m tools.loadtest`` from the repository root. Server CPU and memory usage are
+read from ``/proc``, and so are only reported on Linux. Note that the load generator itself can
+easily become the bottleneck with thousands of clients; its own CPU usage is reported as well,
+and only ``--observers`` clients actually look at what they receive to keep this down.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import secrets
+import socket
+import string
+import subprocess
+import sys
+import time
+import urllib.request
+from dataclasses import dataclass, field
+from pathlib import Path
+from uuid import uuid4
+
+import websockets
+
+ROOT = Path(__file__).parent.parent
+KEY_PREFIX = "loadtest-"
+MARKER = re.compile(r"#lt(\d+)")
+# at most this many handshakes are done at once, so that connecting doesn't turn into a
+# load test of its own
+CONNECT_CONCURRENCY = 50
+
+
+@dataclass
+class LoadTestUser:
+    """In-memory stand-in for a user document, with everything connections actually use"""
+
+    id: object
+    user_id: int
+    key: str
+    admin: bool = False
+    banned: bool = False
+    ban_reason: str | None = None
+    muted_until: None = None
+    mute_reason: str | None = None
+    linked_account: str | None = None
+    is_muted: bool = False
+
+
+def serve(port: int, users: int, *, any_key: bool = False) -> None:
+    """Run the server with every ``loadtest-<n>`` key belonging to a user, and no database
+
+    With ``any_key``, a new user is made up for any other key on first use as well.
+    """
+    import uvicorn
+    from beanie import PydanticObjectId
+
+    import server
+    from auth import key_cache
+
+    accounts = {
+        f"{KEY_PREFIX}{i}": LoadTestUser(id=PydanticObjectId(), user_id=i, key=f"{KEY_PREFIX}{i}")
+        for i in range(users)
+    }
+
+    async def init():
+        pass
+
+    async def get(key: str):
+        if any_key and key not in accounts:
+            accounts[key] = LoadTestUser(id=PydanticObjectId(), user_id=len(accounts), key=key)
+        return accounts.get(key)
+
+    server.init = init
+    key_cache.get = get
+    uvicorn.run(server.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+@dataclass
+class Results:
+    # message number -> when it was sent
+    sent_at: dict[int, float] = field(default_factory=dict)
+    latencies: list[float] = field(default_factory=list)
+    received: int = 0
+    failed_to_connect: int = 0
+
+
+class Client:
+    def __init__(self, url: str, *, api_version: int | None, observer: bool, headers: dict):
+        self.url = url
+        # None for the bot
+        self.api_version = api_version
+        self.observer = observer
+        self.headers = headers
+        self.ws: websockets.WebSocketClientProtocol | None = None
+        self.last_received = 0.0
+        # set once the connection is closed, by either side
+        self.close_code: int | None = None
+
+    async def connect(self) -> None:
+        self.ws = await websockets.connect(self.url, extra_headers=self.headers, max_queue=None)
+
+    async def send(self, seq: int, filler: str) -> None:
+        text = f"#lt{seq} {filler}"
+        if self.api_version is None:
+            payload = {"author": "[DISCORD] loadtest", "message": text, "nonce": str(uuid4())}
+            await self.ws.send(json.dumps(payload))
+        elif self.api_version == 0:
+            await self.ws.send(text)
+        else:
+            await self.ws.send(json.dumps({"type": "send", "data": text, "nonce": str(uuid4())}))
+
+    async def receive(self, results: Results) -> None:
+        try:
+            async for frame in self.ws:
+                now = time.perf_counter()
+                self.last_received = now
+                results.received += 1
+                if self.observer and (match := MARKER.search(frame)):
+                    if (sent := results.sent_at.get(int(match[1]))) is not None:
+                        results.latencies.append(now - sent)
+        except websockets.ConnectionClosed:
+            pass
+        self.close_code = self.ws.close_code or 1006
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def cpu_seconds(pid: int) -> float | None:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the process name may contain spaces, so skip past it first
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def rss_bytes(pid: int) -> int | None:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def scrape(port: int, bot_key: str) -> dict[str, float]:
+    """Get the server's own counters, summed over their labels"""
+    url = f"http://127.0.0.1:{port}/metrics"
+    request = urllib.request.Request(url, headers={"bot-key": bot_key})
+    totals = {}
+    with urllib.request.urlopen(request, timeout=5) as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith("#") or not line:
+                continue
+            name, value = line.rsplit(" ", 1)
+            name = name.split("{", 1)[0]
+            totals[name] = totals.get(name, 0) + float(value)
+    return totals
+
+
+async def wait_for_server(port: int, process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("The server exited before it started accepting connections")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return
+    raise SystemExit(f"The server didn't start accepting connections within {timeout}s")
+
+
+def start_server(*args: str) -> tuple[subprocess.Popen, int, str]:
+    """Start a server in the background as if by :func:`serve`, returning it, its port and its
+    bot key"""
+    port = free_port()
+    bot_key = secrets.token_urlsafe(32)
+    env = {
+        **os.environ,
+        "BOT_KEY": bot_key,
+        "BRIDGE_PORT": str(port),
+        "DISCORD_TOKEN": "",
+        # anything generated here is of no use to anyone, least of all in a real capture
+        "CAPTURE_FILE": "",
+    }
+    process = subprocess.Popen(
+        [sys.executable, "-m", "tools.loadtest", "--serve", "--port", str(port), *args],
+        cwd=ROOT,
+        env=env,
+    )
+    return process, port, bot_key
+
+
+def percentile(values: list[float], p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run(args: argparse.Namespace, port: int, pid: int, bot_key: str) -> None:
+    results = Results()
+    rng = random.Random(args.seed)
+    base = f"ws://127.0.0.1:{port}"
+    rss_idle = rss_bytes(pid)
+
+    bot = Client(f"{base}/bot/{bot_key}", api_version=None, observer=False, headers={})
+    clients = []
+    for i in range(args.clients):
+        api_version = 0 if rng.random() < args.v0_share else 1
+        clients.append(
+            Client(
+                f"{base}/ws/loadtest{i}/{KEY_PREFIX}{i}",
+                api_version=api_version,
+                observer=i < args.observers,
+                headers={"api-version": str(api_version)},
+            )
+        )
+
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(client: Client) -> bool:
+        async with semaphore:
+            try:
+                await client.connect()
+            except (OSError, websockets.WebSocketException, asyncio.TimeoutError):
+                results.failed_to_connect += 1
+                return False
+            return True
+
+    print(f"Connecting {len(clients)} clients...")
+    start = time.perf_counter()
+    await bot.connect()
+    connected = [c for c, ok in zip(clients, await asyncio.gather(*map(connect, clients))) if ok]
+    print(f"Connected {len(connected)} clients in {time.perf_counter() - start:.1f}s")
+    receivers = [asyncio.create_task(c.receive(results)) for c in (bot, *connected)]
+    # give the server a moment to settle, e.g. flushing the outdated client warning sent to v0
+    await asyncio.sleep(1)
+    rss_connected = rss_bytes(pid)
+
+    filler = "".join(rng.choice(string.ascii_lowercase + " ") for _ in range(args.message_size))
+    messages = int(args.rate * args.duration)
+    interval = 1 / args.rate
+    behind = 0.0
+
+    print(f"Sending {messages} messages over {args.duration}s...")
+    metrics_before = await asyncio.to_thread(scrape, port, bot_key)
+    cpu_before, own_before = cpu_seconds(pid), time.process_time()
+    received_before = results.received
+    start = time.perf_counter()
+    for seq in range(messages):
+        # messages are sent on a fixed schedule, rather than being spaced out by a fixed
+        # interval, so that the load doesn't back off when the server falls behind
+        delay = start + seq * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            behind = max(behind, -delay)
+        sender = bot if rng.random() < args.bot_share or not connected else rng.choice(connected)
+        if sender.close_code is not None:
+            continue
+        results.sent_at[seq] = time.perf_counter()
+        try:
+            await sender.send(seq, filler)
+        except websockets.ConnectionClosed:
+            pass
+    sending_ended = time.perf_counter()
+    await asyncio.sleep(args.drain)
+    elapsed = time.perf_counter() - start
+    cpu_after, own_after = cpu_seconds(pid), time.process_time()
+    metrics_after = await asyncio.to_thread(scrape, port, bot_key)
+
+    # anything closed by this point was closed by the server
+    dropped: dict[int, int] = {}
+    for client in connected:
+        if client.close_code is not None:
+            dropped[client.close_code] = dropped.get(client.close_code, 0) + 1
+    bot_closed = bot.close_code
+    stalled = sum(
+        client.close_code is None and sending_ended - client.last_received > args.stall_timeout
+        for client in connected
+    )
+    for client in (bot, *connected):
+        await client.ws.close()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    def delta(name: str) -> float:
+        return metrics_after.get(name, 0) - metrics_before.get(name, 0)
+
+    sent = len(results.sent_at)
+    frames = results.received - received_before
+    print()
+    print(f"{'sent':>24}: {sent} messages ({sent / (sending_ended - start):.1f}/s)")
+    if behind > interval:
+        print(f"{'':>24}  fell up to {behind * 1000:.0f}ms behind schedule")
+    print(f"{'rejected':>24}: {delta('bridge_rejected_messages_total'):.0f}")
+    print(f"{'received':>24}: {frames} frames across all clients")
+    print(f"{'dropped frames':>24}: {delta('bridge_dropped_frames_total'):.0f} (full send queues)")
+    if results.latencies:
+        latencies = sorted(results.latencies)
+        print(
+            f"{'broadcast latency':>24}: "
+            + ", ".join(
+                f"p{p:g} {percentile(latencies, p) * 1000:.2f}ms" for p in (50, 90, 99, 99.9)
+            )
+            + f", max {latencies[-1] * 1000:.2f}ms ({len(latencies)} samples)"
+        )
+    if cpu_before is not None and cpu_after is not None:
+        cpu = cpu_after - cpu_before
+        print(
+            f"{'server cpu':>24}: {cpu:.2f}s ({cpu / elapsed:.0%} of a core),"
+            f" {cpu / max(sent, 1) * 1e6:.0f}µs/message, {cpu / max(frames, 1) * 1e6:.1f}µs/frame"
+        )
+    if rss_idle is not None and rss_connected is not None:
+        per_connection = (rss_connected - rss_idle) / max(len(connected), 1)
+        print(
+            f"{'server memory':>24}: {rss_connected / 2**20:.1f}MiB,"
+            f" ~{per_connection / 1024:.1f}KiB/connection"
+        )
+    own = own_after - own_before
+    print(f"{'load generator cpu':>24}: {own / elapsed:.0%} of a core")
+    if own / elapsed > 0.8:
+        print(f"{'':>24}  the load generator is likely the bottleneck; results may be skewed")
+    print(
+        f"{'connections':>24}: {len(connected)} connected,"
+        f" {results.failed_to_connect} failed to connect, {stalled} stalled,"
+        f" {sum(dropped.values())} dropped" + (f" (close codes: {dropped})" if dropped else "")
+    )
+    if bot_closed is not None:
+        print(f"{'':>24}  the bot was disconnected with code {bot_closed}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--observers", type=int, default=50, help="clients measuring latency")
+    parser.add_argument("--v0-share", type=float, default=0.2, help="fraction of v0 clients")
+    parser.add_argument("--bot-share", type=float, default=0.2, help="fraction sent by the bot")
+    parser.add_argument("--rate", type=float, default=20, help="messages per second, in total")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to send for")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait after sending")
+    parser.add_argument("--message-size", type=int, default=60)
+    parser.add_argument("--stall-timeout", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--any-key", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, args.clients, any_key=args.any_key)
+        return
+
+    process, port, bot_key = start_server("--clients", str(args.clients))
+    try:
+        asyncio.run(_main(args, port, process, bot_key))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+async def _main(args, port: int, process: subprocess.Popen, bot_key: str) -> None:
+    await wait_for_server(port, process)
+    await run(args, port, process.pid, bot_key)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+Replays traffic recorded with CAPTURE_FILE against a local server, and reports how it held up.
+
+Starts a server the same way as tools/loadtest.py does (users served from memory, with any key
+being accepted), then replays every connection, frame and disconnect from one or more capture
+files at the pace they originally happened at, or ``--speed`` times faster. Reports:
+
+- how many messages were sent, and the throughput that was actually achieved
+- broadcast latency percentiles for every message carrying a nonce; API v0 clients don't send
+  any, so their messages are replayed but not measured
+- server CPU time per message, and frames the server dropped or rejected
+
+``--output`` saves these as JSON, and ``--baseline`` compares them against an earlier run (e.g.
+of a previous build); with ``--check``, this exits with a non-zero status if latency, CPU per
+message or throughput got worse by more than ``--threshold`` times. Throughput only says much
+when replaying faster than the capture happened, as it's otherwise set by the capture itself.
+
+Run with ``python -m tools.replay capture.jsonl`` from the repository root.
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+import msgpack
+import orjson
+import websockets
+
+from tools.loadtest import cpu_seconds, percentile, scrape, start_server, wait_for_server
+
+NONCE = re.compile(r'"nonce":"([^"]+)"')
+# how each metric is compared against a baseline; True if higher is better
+METRICS = {
+    "throughput": True,
+    "latency_p50": False,
+    "latency_p90": False,
+    "latency_p99": False,
+    "cpu_per_message": False,
+}
+
+
+class Stats:
+    def __init__(self):
+        # nonce -> when it was sent
+        self.sent_at: dict[str, float] = {}
+        self.messages = 0
+        self.latencies: list[float] = []
+        self.received = 0
+        self.failed_to_connect = 0
+        self.dropped = 0
+
+
+class Replayed:
+    """A single connection from a capture, replaying its frames in order as they're given"""
+
+    def __init__(self, event: dict, base: str, bot_key: str, *, observer: bool):
+        self.bot = event.get("bot", False)
+        self.api_version = event.get("v", 1)
+        self.encoding = event.get("enc", "json")
+        if self.bot:
+            self.url, self.headers = f"{base}/bot/{bot_key}", {}
+        else:
+            self.url = f"{base}/ws/{event['u']}/{event['k']}"
+            self.headers = {"api-version": str(self.api_version), "api-encoding": self.encoding}
+        self.observer = observer
+        self.queue: asyncio.Queue[dict] = asyncio.Queue()
+        self.ws: websockets.WebSocketClientProtocol | None = None
+        self.closed_by_us = False
+
+    def _encode(self, data) -> str | bytes:
+        if self.api_version == 0 and not self.bot:
+            return data
+        if self.api_version == 2 and self.encoding == "msgpack":
+            return msgpack.packb(data)
+        return orjson.dumps(data).decode()
+
+    @staticmethod
+    def _messages(data) -> list[dict]:
+        """Whatever in a frame would be broadcast"""
+        items = data if isinstance(data, list) else [data]
+        return [x for x in items if isinstance(x, dict) and x.get("type", "send") == "send"]
+
+    async def run(self, stats: Stats) -> None:
+        try:
+            self.ws = await websockets.connect(self.url, extra_headers=self.headers, max_queue=None)
+        except (OSError, websockets.WebSocketException, asyncio.TimeoutError):
+            stats.failed_to_connect += 1
+            return
+        receiver = asyncio.create_task(self._receive(stats))
+        try:
+            while (event := await self.queue.get())["e"] != "disconnect":
+                data = event["d"]
+                now = time.perf_counter()
+                if isinstance(data, str):
+                    stats.messages += 1
+                for message in self._messages(data):
+                    stats.messages += 1
+                    if isinstance(nonce := message.get("nonce"), str):
+                        stats.sent_at[nonce] = now
+                await self.ws.send(self._encode(data))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.closed_by_us = True
+            await self.ws.close()
+            await receiver
+
+    async def _receive(self, stats: Stats) -> None:
+        try:
+            async for frame in self.ws:
+                now = time.perf_counter()
+                stats.received += 1
+                if self.observer and isinstance(frame, str):
+                    for nonce in NONCE.findall(frame):
+                        if (sent := stats.sent_at.get(nonce)) is not None:
+                            stats.latencies.append(now - sent)
+        except websockets.ConnectionClosed:
+            pass
+        if not self.closed_by_us:
+            stats.dropped += 1
+
+
+def load(paths: list[Path]) -> list[dict]:
+    events = []
+    for path in paths:
+        with open(path, "rb") as f:
+            for line in f:
+                if line.strip() and (event := orjson.loads(line))["e"] != "start":
+                    events.append(event)
+    events.sort(key=lambda x: x["t"])
+    return events
+
+
+async def replay(args: argparse.Namespace, port: int, pid: int, bot_key: str) -> dict:
+    events = load(args.captures)
+    if not events:
+        raise SystemExit("Nothing to replay")
+    stats = Stats()
+    base = f"ws://127.0.0.1:{port}"
+    connections: dict[str, Replayed] = {}
+    tasks: list[asyncio.Task] = []
+    observers = 0
+    skipped = 0
+    behind = 0.0
+
+    span = events[-1]["t"] - events[0]["t"]
+    print(f"Replaying {len(events)} events spanning {span:.0f}s at {args.speed:g}x speed...")
+    metrics_before = await asyncio.to_thread(scrape, port, bot_key)
+    cpu_before = cpu_seconds(pid)
+    start = time.perf_counter()
+    for event in events:
+        delay = start + (event["t"] - events[0]["t"]) / args.speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            behind = max(behind, -delay)
+
+        if event["e"] == "connect":
+            observer = observers < args.observers and not event.get("bot", False)
+            observers += observer
+            connection = connections[event["c"]] = Replayed(event, base, bot_key, observer=observer)
+            tasks.append(asyncio.create_task(connection.run(stats)))
+        elif connection := connections.get(event["c"]):
+            connection.queue.put_nowait(event)
+        else:
+            # the connection was opened before the capture was started
+            skipped += 1
+    replayed = time.perf_counter() - start
+
+    await asyncio.sleep(args.drain)
+    cpu_after = cpu_seconds(pid)
+    metrics_after = await asyncio.to_thread(scrape, port, bot_key)
+    for connection in connections.values():
+        connection.queue.put_nowait({"e": "disconnect"})
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    latencies = sorted(stats.latencies)
+    results = {
+        "messages": stats.messages,
+        "duration": replayed,
+        "throughput": stats.messages / replayed if replayed else 0,
+        "frames_received": stats.received,
+        "latency_samples": len(latencies),
+        "latency_p50": percentile(latencies, 50) if latencies else None,
+        "latency_p90": percentile(latencies, 90) if latencies else None,
+        "latency_p99": percentile(latencies, 99) if latencies else None,
+        "latency_max": latencies[-1] if latencies else None,
+        "cpu_per_message": (
+            (cpu_after - cpu_before) / max(stats.messages, 1)
+            if cpu_before is not None and cpu_after is not None
+            else None
+        ),
+        "rejected": metrics_after.get("bridge_rejected_messages_total", 0)
+        - metrics_before.get("bridge_rejected_messages_total", 0),
+        "dropped_frames": metrics_after.get("bridge_dropped_frames_total", 0)
+        - metrics_before.get("bridge_dropped_frames_total", 0),
+        "dropped_connections": stats.dropped,
+        "failed_connections": stats.failed_to_connect,
+        "skipped_events": skipped,
+        "max_behind": behind,
+    }
+
+    print()
+    for name, value in results.items():
+        if isinstance(value, float) and name.startswith(("latency_", "cpu_", "max_")):
+            print(f"{name:>20}: {value * 1000:.3f}ms")
+        elif isinstance(value, float):
+            print(f"{name:>20}: {value:.2f}")
+        else:
+            print(f"{name:>20}: {value}")
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Print how the key metrics compare against a baseline, returning any that regressed"""
+    regressed = []
+    print()
+    print(f"{'metric':>20} | {'baseline':>12} | {'current':>12} | slowdown")
+    for name, higher_is_better in METRICS.items():
+        previous, current = baseline.get(name), results.get(name)
+        if not previous or not current:
+            continue
+        ratio = previous / current if higher_is_better else current / previous
+        if ratio > threshold:
+            regressed.append(name)
+        print(
+            f"{name:>20} | {previous:>12.6g} | {current:>12.6g} | {ratio:.2f}x"
+            + (" REGRESSED" if ratio > threshold else "")
+        )
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("captures", type=Path, nargs="+")
+    parser.add_argument("--speed", type=float, default=1.0, help="how much faster to replay at")
+    parser.add_argument("--observers", type=int, default=50, help="clients measuring latency")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait after replaying")
+    parser.add_argument("--output", type=Path, help="where to save results")
+    parser.add_argument("--baseline", type=Path, help="earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown to fail at")
+    parser.add_argument("--check", action="store_true", help="fail if anything regressed")
+    args = parser.parse_args()
+
+    process, port, bot_key = start_server("--clients", "0", "--any-key")
+    try:
+        results = asyncio.run(_main(args, port, process, bot_key))
+    finally:
+        process.terminate()
+        process.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressed = compare(results, json.load(f), args.threshold)
+        if regressed and args.check:
+            print(f"\n{len(regressed)} metric(s) regressed by more than {args.threshold}x")
+            sys.exit(1)
+
+
+async def _main(args, port: int, process, bot_key: str) -> dict:
+    await wait_for_server(port, process)
+    return await replay(args, port, process.pid, bot_key)
+
+
+if __name__ == "__main__":
+    main()
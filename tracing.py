@@ -0,0 +1,78 @@
+"""
+Sampled per-message latency tracing, keyed by message nonces.
+
+Whether a message is traced is decided purely from its nonce, so the server and the bot each
+independently trace the exact same messages without anything extra having to be sent between
+them. Each process only keeps its own half of a trace; the bot puts both halves back together
+when queried (see the ``trace`` operation). Timestamps are wall clock times, so that both
+halves can be lined up against each other.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+from collections import OrderedDict
+from zlib import crc32
+
+__all__ = ("Stage", "Tracer", "tracer")
+
+# stage name -> [first seen, last seen, times seen]; stages that happen once per connection
+# (e.g. writes) are seen multiple times, and the spread between these shows the slowest one
+Stage = list[float | int]
+
+
+class Tracer:
+    def __init__(self, sample_rate: float = 0.0, maxlen: int = 1000):
+        self.maxlen = maxlen
+        self.sample_rate = sample_rate
+        self._traces: OrderedDict[str, dict[str, Stage]] = OrderedDict()
+
+    @property
+    def sample_rate(self) -> float:
+        return self._threshold / 2**32
+
+    @sample_rate.setter
+    def sample_rate(self, value: float) -> None:
+        self._threshold = int(min(max(value, 0.0), 1.0) * 2**32)
+        self.enabled = self._threshold > 0
+
+    def load_config(self) -> None:
+        self.sample_rate = float(os.getenv("TRACE_SAMPLE_RATE", 0))
+        self.maxlen = int(os.getenv("TRACE_SIZE", 1000))
+
+    def sampled(self, nonce: str | None) -> bool:
+        """Whether the message with the given nonce is being traced"""
+        if not self.enabled or not isinstance(nonce, str):
+            return False
+        return crc32(nonce.encode()) < self._threshold
+
+    def mark(self, nonce: str | None, stage: str, at: float | None = None) -> None:
+        """Record that a message reached the given stage, if it's being traced"""
+        if self.sampled(nonce):
+            self.record(nonce, stage, at)
+
+    def record(self, nonce: str, stage: str, at: float | None = None) -> None:
+        """Like :meth:`mark`, for callers that have already checked :meth:`sampled`"""
+        at = time.time() if at is None else at
+        if (trace := self._traces.get(nonce)) is None:
+            trace = self._traces[nonce] = {}
+            while len(self._traces) > self.maxlen:
+                self._traces.popitem(last=False)
+        if (seen := trace.get(stage)) is None:
+            trace[stage] = [at, at, 1]
+        else:
+            seen[0] = min(seen[0], at)
+            seen[1] = max(seen[1], at)
+            seen[2] += 1
+
+    def get(self, nonce: str) -> dict[str, Stage] | None:
+        return self._traces.get(nonce)
+
+    def recent(self, limit: int = 10) -> dict[str, dict[str, Stage]]:
+        """The most recently started traces, newest first"""
+        nonces = list(self._traces)[-limit:] if limit > 0 else []
+        return {x: self._traces[x] for x in reversed(nonces)}
+
+
+tracer = Tracer()
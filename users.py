@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+from typing import Iterable
+
+from cache import TTLCache
+from db import User
+
+__all__ = ("UserCache", "user_cache")
+_MISSING = object()
+
+
+class UserCache:
+    """Bot-side cache of user documents, keyed by Discord user ID
+
+    The server pushes an invalidation over the bot websocket whenever it changes a user, so
+    entries can be held onto for fairly long; the TTL is only a safety net for changes made
+    outside of either process. Users without a document are cached as well, as that's the case
+    for most people talking in the bridge channel.
+    """
+
+    def __init__(self, maxsize: int = 5_000, ttl: float = 600):
+        self._cache: TTLCache[int, User | None] = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, user_id: int) -> User | None:
+        if (user := self._cache.get(user_id, _MISSING)) is not _MISSING:
+            return user
+        user = await User.find_one({"user_id": user_id})
+        self._cache.set(user_id, user)
+        return user
+
+    async def get_many(self, user_ids: Iterable[int]) -> dict[int, User]:
+        """Get every user with a document out of the given user IDs"""
+        found: dict[int, User] = {}
+        missing: list[int] = []
+        for user_id in user_ids:
+            if (user := self._cache.get(user_id, _MISSING)) is _MISSING:
+                missing.append(user_id)
+            elif user is not None:
+                found[user_id] = user
+
+        if missing:
+            async for user in User.find_many({"user_id": {"$in": missing}}):
+                found[user.user_id] = user
+            for user_id in missing:
+                self._cache.set(user_id, found.get(user_id))
+        return found
+
+    def invalidate(self, user_id: int) -> None:
+        self._cache.pop(user_id)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+user_cache = UserCache()